@@ -39,6 +39,8 @@ SocialRisk = {'2015':[x  + random.expovariate(4) for x in riskRand]}
 
 import pandas as pd
 from decimal import *
+from hcc_db import connect, fetch_chunks
+from hcc_visits import VISIT_CODES
 getcontext().prec = 2
 TotalMembership = 45000.0
 TotalExpense = TotalMembership*10000
@@ -87,11 +89,19 @@ def getColor(count):
 
 
 
+_pool = None
+
 def dbConnect(constring):
-	return True
+	# a pool of connections to a sqlite:/// database, used by cursor()
+	global _pool
+	_pool = connect(constring)
+	return _pool
 
-def cursor(query):
-	return range(int(TotalMembership * 2.4))
+def cursor(query, chunk_size=10000):
+	# the rows of query, fetched chunk_size at a time
+	for rows in fetch_chunks(_pool, query, chunk_size=chunk_size):
+		for row in rows:
+			yield row
 
 def width_calc(value):
     width = value*5
@@ -191,10 +201,6 @@ hcc_labels = {'HCC1':"AIDS",
 'HCC189':"Amputation_Complicated"}
 
 
-office =['99201','99202','99203','99204','99205','99211','99212','99213','99214','99215']
-nursing_facility = ['99304','99304','99305','99306','99307','99308','99309','99310', '99315','99316','99318']
-rest_home = ['99324','99325','99326','99327','99328','99334','99335','99336','99337','99339','99340']
-home_services = ['99341','99342','99343','99344','99345','99347','99348','99349','99350','99490','99495','99496']
-wellness_visits = ['G0402','G0438','G0439']
+office, nursing_facility, rest_home, home_services, wellness_visits = [codes for _, codes in VISIT_CODES]
 preven_codes = [x for x in [office, nursing_facility, rest_home, wellness_visits]]
 
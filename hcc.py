@@ -1,7 +1,8 @@
 from enum import Enum,IntEnum
 from functools import reduce
 from datetime import datetime
-from pyDatalog import pyDatalog
+from pyDatalog import pyDatalog, Logic
+from pyDatalog.pyDatalog import metaMixin
 import os
 
 pyDatalog.create_terms("""
@@ -22,6 +23,18 @@ pyDatalog.create_terms("X,Y,Z")
 def age_as_of(dob,date_as_of):
   return date_as_of.year - dob.year - ((date_as_of.month, date_as_of.day) < (dob.month, dob.day))
 
+def payment_year_as_of(year):
+  # CMS computes ages as of February 1 of the payment year
+  return datetime(year,2,1)
+
+def as_of_date(as_of=None):
+  # a datetime from a datetime/date, a YYYYMMDD string or None (today)
+  if as_of is None:
+    return datetime.now()
+  if isinstance(as_of,str):
+    return datetime.strptime(as_of,"%Y%m%d")
+  return as_of
+
 class EntitlementReason(IntEnum):
   OASI=0
   DIB=1
@@ -50,12 +63,16 @@ class Beneficiary(pyDatalog.Mixin):
               hicno,sex,dob,
               original_reason_entitlement=EntitlementReason.OASI,
               medicaid=False,
-              newenrollee_medicaid=False,):
+              newenrollee_medicaid=False,
+              as_of=None):
+    # the age is taken on as_of (see as_of_date), e.g.
+    # payment_year_as_of(2017); today if left out
+    load()
     super().__init__()
     self.hicno = hicno
     self.sex = sex
     self.dob = datetime.strptime(dob,"%Y%m%d")
-    self.age = age_as_of(self.dob,datetime.now())
+    self.age = age_as_of(self.dob,as_of_date(as_of))
     self.medicaid = medicaid
     self.newenrollee_medicaid = newenrollee_medicaid
     self.original_reason_entitlement = original_reason_entitlement
@@ -68,7 +85,7 @@ class Beneficiary(pyDatalog.Mixin):
     self.diagnoses.append(diag)
 
 # lines 352 - 361
-def load_diagnostic_category_facts():
+def diagnostic_categories():
   diagnostic_categories = [
           ("cancer",["8","9","10","11","12"]),
           ("diabetes",["17","18","19"]),
@@ -80,31 +97,44 @@ def load_diagnostic_category_facts():
           ("compl",["176"]),
           ("pressure_ulcer",["157","158","159","160"]),
           ("sepsis",["2"]) ]
-  for dcE, ccs in diagnostic_categories:
+  return diagnostic_categories
+
+def load_diagnostic_category_facts():
+  for dcE, ccs in diagnostic_categories():
     for ccE in ccs:
       + dc(dcE,ccE)
 
-def load_coefficients(f):
+def read_coefficients(f):
   dir = os.path.dirname(__file__)
-  file = open(os.path.join(dir,f), 'r')                                     
-  for line in file:
-    vals = list(map(lambda s: s.strip(),line.split(",")))
-    label,coeff = vals
-    + coefficient(label,float(coeff)) 
+  with open(os.path.join(dir,f), 'r') as file:
+    for line in file:
+      vals = list(map(lambda s: s.strip(),line.split(",")))
+      label,coeff = vals
+      yield label,float(coeff)
+
+def load_coefficients(f):
+  for label,coeff in read_coefficients(f):
+    + coefficient(label,coeff) 
   + coefficient('starting',0.00)
 
-def load_cc_facts(f,icdcodetype):
+def read_cc_facts(f):
   dir = os.path.dirname(__file__)
-  file = open(os.path.join(dir,f), 'r')                                     
-  for line in file:
-    vals = line.split()
-    if len(vals) == 2:
-      icdE,ccE = vals
-    elif len(vals) == 3:
-      icdE,ccE,_ = vals
+  with open(os.path.join(dir,f), 'r') as file:
+    for line in file:
+      vals = line.split()
+      if len(vals) == 2:
+        icdE,ccE = vals
+      elif len(vals) == 3:
+        icdE,ccE,_ = vals
+      else:
+        continue
+      yield icdE,ccE
+
+def load_cc_facts(f,icdcodetype):
+  for icdE,ccE in read_cc_facts(f):
     + cc(icdE,ccE,icdcodetype) 
 
-def load_hcc_facts():
+def hcc_hierarchy():
   overriders = [
           ("8",["9","10","11","12" ]),
           ("9",["10","11","12" ]),
@@ -145,10 +175,48 @@ def load_hcc_facts():
           ("160",["161" ]),
           ("166",["80","167" ])
           ]
-  for overrider, overridees in overriders:
+  return overriders
+
+def load_hcc_facts():
+  for overrider, overridees in hcc_hierarchy():
     for overridee in overridees:
       + overrides(overrider,overridee)
 
+def cc_edits():
+  # (codetype, CC, sex, age limit, icd codes)
+  # a sex edit applies to that sex, an age edit applies below the age limit
+  edits = [
+          (9,"48","female",None,["2860", "2861"]),
+          (9,"112",None,18,["4910", "4911", "49120", "49121", "49122",
+                            "4918", "4919", "4920",  "4928",  "496",  
+                            "5181", "5182"]),
+          (0,"48","female",None,["D66", "D67"]),
+          (0,"112",None,18,["J410", 
+                            "J411", "J418", "J42",  "J430",
+                            "J431", "J432", "J438", "J439", "J440",
+                            "J441", "J449", "J982", "J983"])
+          ]
+  return edits
+
+def cc_excisions():
+  #IF &AGE < 18 AND &ICD9 IN ("49320", "49321", "49322") 
+  #                                           THEN CC="-1.0";
+  excisions = [
+          (9,18,["49320", "49321", "49322"])
+          ]
+  return excisions
+
+def hcc_codes():
+  hccees = [ 
+        '100', '103', '104', '106', '107', '108', '10', '110', '111', '112', '114', '115', 
+        '11', '122', '124', '12', '134', '135', '136', '137', '138', '139', '140', '141', 
+        '157', '158', '159', '160', '161', '162', '166', '167', '169', '170', '173', '176', 
+        '17', '186', '188', '189', '18', '19', '1', '21', '22', '23', '27', '28', '29', '2', 
+        '33', '34', '35', '39', '40', '46', '47', '48', '51', '52', '54', '55', '57', '58', 
+        '6', '70', '71', '72', '73', '74', '75', '76', '77', '78', '79', '80', '82', '83', 
+        '84', '85', '86', '87', '88', '8', '96', '99', '9']
+  return hccees
+
 def load_facts():
   
   load_cc_facts("icd10.txt",0)
@@ -240,20 +308,14 @@ def load_rules():
   #    ORIGDS  = (&OREC = '1')*(DISABL = 0);
   originally_disabled(B) <= (Ben.original_reason_entitlement[B] == EntitlementReason.DIB) & ~(disabled(B))
 
-  edit(ICD,9,B,"48")  <= female(B) & (ICD.in_(["2860", "2861"]))
-  edit(ICD,9,B,"112") <= age(B,A)  & (A < 18) & \
-                              (ICD.in_(["4910", "4911", "49120", "49121", "49122",
-                                        "4918", "4919", "4920",  "4928",  "496",  
-                                        "5181", "5182"]))
-  edit(ICD,0,B,"48")  <= female(B) & (ICD.in_(["D66", "D67"]))
-  edit(ICD,0,B,"112") <= age(B,A)  & (A < 18) & (ICD.in_(["J410", 
-                                 "J411", "J418", "J42",  "J430",
-                                 "J431", "J432", "J438", "J439", "J440",
-                                 "J441", "J449", "J982", "J983"]))
+  for icdtype, ccE, sexE, max_age, icds in cc_edits():
+    if sexE is not None:
+      edit(ICD,icdtype,B,ccE) <= (Ben.sex[B] == sexE) & (ICD.in_(icds))
+    else:
+      edit(ICD,icdtype,B,ccE) <= age(B,A)  & (A < max_age) & (ICD.in_(icds))
 
-  #IF &AGE < 18 AND &ICD9 IN ("49320", "49321", "49322") 
-  #                                           THEN CC="-1.0";
-  excised(ICD,9,B) <= age(B,A)  & (A < 18) & (ICD.in_(["49320", "49321", "49322"]))
+  for icdtype, max_age, icds in cc_excisions():
+    excised(ICD,icdtype,B) <= age(B,A)  & (A < max_age) & (ICD.in_(icds))
 
   beneficiary_icd(B,ICD,Type) <= (Diag.beneficiary[D] == B) & (Diag.icdcode[D]==ICD) & (Diag.codetype[D]==Type) 
   beneficiary_has_cc(B,CC) <= beneficiary_icd(B,ICD,Type)  & edit(ICD,Type,B,CC) & ~(excised(ICD,Type,B))
@@ -325,15 +387,7 @@ def load_rules():
   indicator(B,'F85_89') <=  sex_age_range('female',B,85,89)
   indicator(B,'F90_94') <=  sex_age_range('female',B,90,94)
   indicator(B,'F95_GT') <=  sex_age_range('female',B,95,-1.0)
-  hccees = [ 
-        '100', '103', '104', '106', '107', '108', '10', '110', '111', '112', '114', '115', 
-        '11', '122', '124', '12', '134', '135', '136', '137', '138', '139', '140', '141', 
-        '157', '158', '159', '160', '161', '162', '166', '167', '169', '170', '173', '176', 
-        '17', '186', '188', '189', '18', '19', '1', '21', '22', '23', '27', '28', '29', '2', 
-        '33', '34', '35', '39', '40', '46', '47', '48', '51', '52', '54', '55', '57', '58', 
-        '6', '70', '71', '72', '73', '74', '75', '76', '77', '78', '79', '80', '82', '83', 
-        '84', '85', '86', '87', '88', '8', '96', '99', '9']
-  for i in hccees:
+  for i in hcc_codes():
     indicator(B,'HCC' + i ) <=  ben_hcc(B,i) 
   indicator(B,'M0_34') <=  sex_age_range('male',B,0,34)
   indicator(B,'M35_44') <=  sex_age_range('male',B,35,44)
@@ -440,11 +494,11 @@ def load_rules():
   (valid_institutional_variables[B] == concat_(CC,key=CC,sep=',')) <= indicator(B,CC) & CC.in_(ivars)
   (valid_new_enrollee_variables[B] == concat_(CC,key=CC,sep=',')) <= indicator(B,CC) & CC.in_(nevars)
 
-  (new_enrollee_score[B] == sum_(Coef,key=Coef)) <=  indicator(B,CC) \
+  (new_enrollee_score[B] == sum_(Coef,key=CC)) <=  indicator(B,CC) \
                                                 & CC.in_(nevars) & coefficient("NE_"+CC,Coef)
-  (institutional_score[B] == sum_(Coef,key=Coef)) <=  indicator(B,CC) \
+  (institutional_score[B] == sum_(Coef,key=CC)) <=  indicator(B,CC) \
                                                 & CC.in_(ivars) & coefficient("INS_"+CC,Coef)
-  (community_score[B] == sum_(Coef,key=Coef)) <=  indicator(B,CC) \
+  (community_score[B] == sum_(Coef,key=CC)) <=  indicator(B,CC) \
                                                 & CC.in_(cvars) & coefficient("CE_"+CC,Coef)
 
   score(B,"community",Score) <= (community_score[B] == Score)
@@ -455,39 +509,122 @@ def load_rules():
   output(B,Col,1) <= indicator(B,Col)
   output(B,"sex",Val) <= (Ben.sex[B]==Val)
   output(B,"age",Val) <= age(B,Val)
-  
-
-load_facts()
-load_rules()
-
-
-####################################################
-jane = Beneficiary(2,"female","19740824",EntitlementReason.DIB,True)
-jane.add_diagnosis(Diagnosis(jane,"D66",ICDType.TEN))  
-jane.add_diagnosis(Diagnosis(jane,"C182",ICDType.TEN))  
-
-daniel = Beneficiary(1,"male","19740824",EntitlementReason.DIB)
-daniel.add_diagnosis(Diagnosis(daniel,"A0223",ICDType.TEN))  # 51
-daniel.add_diagnosis(Diagnosis(daniel,"A0224",ICDType.TEN))  # 52
-daniel.add_diagnosis(Diagnosis(daniel,"D66",ICDType.TEN))  
-daniel.add_diagnosis(Diagnosis(daniel,"C163",ICDType.TEN))  
-daniel.add_diagnosis(Diagnosis(daniel,"C163",ICDType.TEN))  
-daniel.add_diagnosis(Diagnosis(daniel,"C182",ICDType.TEN))  
-daniel.add_diagnosis(Diagnosis(daniel,"C800",ICDType.TEN))  
-daniel.add_diagnosis(Diagnosis(daniel,"A072",ICDType.TEN))  
-
-bob = Beneficiary(3,"male","20040824",EntitlementReason.DIB,True)
-bob.add_diagnosis(Diagnosis(bob,"A0223",ICDType.TEN))
-bob.add_diagnosis(Diagnosis(bob,"A0224",ICDType.TEN))
-
-jacob = Beneficiary(4,"male","1940824",EntitlementReason.DIB,True)
-
-antonio = Beneficiary(3,"male","20040824",EntitlementReason.DIB,True)
-antonio.add_diagnosis(Diagnosis(antonio,"A0223",ICDType.TEN))
-antonio.add_diagnosis(Diagnosis(antonio,"49320",ICDType.NINE))
-
-john = Beneficiary(5,"male","19920824",EntitlementReason.DIB,True)
-john.add_diagnosis(Diagnosis(john,"A0223",ICDType.TEN))
-john.add_diagnosis(Diagnosis(john,"49320",ICDType.NINE))
 
-####################################################
+def beneficiary_output(b,engine="datalog",version=None,cache=None):
+  # the output(B,Col,Val) rows for one beneficiary, from either the datalog
+  # rules above or the equivalent compiled tables in hcc_compiled, which can
+  # also score any registered model version.  An hcc_cache.ScoreCache as
+  # cache answers repeats of a demographic cell and code set from memory.
+  if cache is not None:
+    return cache.beneficiary_output(b,engine)
+  if engine == "datalog":
+    load()
+    return [tuple(row) for row in output(b,Col,Val)]
+  elif engine == "compiled":
+    from hcc_compiled import get_model
+    return get_model(version).member_output(b)
+  raise ValueError("unknown engine: " + str(engine))
+
+def retract(beneficiaries):
+  # removes beneficiaries and their diagnoses from the datalog store.  Every
+  # live Mixin instance is a fact that queries scan, so a long-running
+  # process retracts members once it has scored them; they are left intact
+  # as python objects.
+  for b in beneficiaries:
+    for obj in list(b.diagnoses) + [b]:
+      for cls in type(obj).__mro__:
+        if cls in metaMixin.__refs__:
+          metaMixin.__refs__[cls].discard(obj)
+  # tabled (memoized) subgoals hold derived facts about them
+  logic = getattr(Logic.tl,"logic",None)
+  if logic is not None:
+    logic.Subgoals = {}
+
+class ScoringSession:
+  # Scores a batch with the datalog rules and retracts every member it saw
+  # on exit, so the store only ever holds the batch in flight:
+  #
+  #   with ScoringSession() as session:
+  #     rows = session.output({"hicno":1, "sex":"male", "dob":"19500101",
+  #                            "diagnoses":[("E1122",0)]})
+  def __init__(self,as_of=None):
+    # members built from dicts are aged on as_of (see as_of_date)
+    self.as_of = as_of
+    self.beneficiaries = []
+
+  def __enter__(self):
+    load()
+    return self
+
+  def __exit__(self,*exc):
+    self.close()
+    return False
+
+  def beneficiary(self,member):
+    # a Beneficiary, or one built from a dict of its constructor fields
+    # (dob as YYYYMMDD) and a 'diagnoses' list of (icdcode, codetype) pairs
+    if isinstance(member,Beneficiary):
+      b = member
+    else:
+      b = Beneficiary(member["hicno"],member["sex"],member["dob"],
+                      member.get("original_reason_entitlement",EntitlementReason.OASI),
+                      member.get("medicaid",False),
+                      member.get("newenrollee_medicaid",False),
+                      self.as_of)
+      for icdcode, codetype in member.get("diagnoses",()):
+        b.add_diagnosis(Diagnosis(b,icdcode,codetype))
+    self.beneficiaries.append(b)
+    return b
+
+  def output(self,member):
+    return beneficiary_output(self.beneficiary(member))
+
+  def score(self,members):
+    # [(hicno, output rows)] for a batch of members
+    return [(b.hicno,beneficiary_output(b)) for b in map(self.beneficiary,members)]
+
+  def close(self):
+    retract(self.beneficiaries)
+    self.beneficiaries = []
+
+
+def load():
+  # asserts the reference facts and defines the rules, once per pyDatalog
+  # logic (each thread has its own; see hcc_engine).  Nothing is loaded at
+  # import time; the first Beneficiary does it, since the datalog queries
+  # only make sense once beneficiaries exist.
+  logic = Logic(True)
+  if not getattr(logic,"hcc_loaded",False):
+    load_facts()
+    load_rules()
+    logic.hcc_loaded = True
+
+def demo_beneficiaries():
+  jane = Beneficiary(2,"female","19740824",EntitlementReason.DIB,True)
+  jane.add_diagnosis(Diagnosis(jane,"D66",ICDType.TEN))  
+  jane.add_diagnosis(Diagnosis(jane,"C182",ICDType.TEN))  
+
+  daniel = Beneficiary(1,"male","19740824",EntitlementReason.DIB)
+  daniel.add_diagnosis(Diagnosis(daniel,"A0223",ICDType.TEN))  # 51
+  daniel.add_diagnosis(Diagnosis(daniel,"A0224",ICDType.TEN))  # 52
+  daniel.add_diagnosis(Diagnosis(daniel,"D66",ICDType.TEN))  
+  daniel.add_diagnosis(Diagnosis(daniel,"C163",ICDType.TEN))  
+  daniel.add_diagnosis(Diagnosis(daniel,"C163",ICDType.TEN))  
+  daniel.add_diagnosis(Diagnosis(daniel,"C182",ICDType.TEN))  
+  daniel.add_diagnosis(Diagnosis(daniel,"C800",ICDType.TEN))  
+  daniel.add_diagnosis(Diagnosis(daniel,"A072",ICDType.TEN))  
+
+  bob = Beneficiary(3,"male","20040824",EntitlementReason.DIB,True)
+  bob.add_diagnosis(Diagnosis(bob,"A0223",ICDType.TEN))
+  bob.add_diagnosis(Diagnosis(bob,"A0224",ICDType.TEN))
+
+  jacob = Beneficiary(4,"male","1940824",EntitlementReason.DIB,True)
+
+  antonio = Beneficiary(3,"male","20040824",EntitlementReason.DIB,True)
+  antonio.add_diagnosis(Diagnosis(antonio,"A0223",ICDType.TEN))
+  antonio.add_diagnosis(Diagnosis(antonio,"49320",ICDType.NINE))
+
+  john = Beneficiary(5,"male","19920824",EntitlementReason.DIB,True)
+  john.add_diagnosis(Diagnosis(john,"A0223",ICDType.TEN))
+  john.add_diagnosis(Diagnosis(john,"49320",ICDType.NINE))
+  return [jane, daniel, bob, jacob, antonio, john]
@@ -0,0 +1,132 @@
+import numpy as np
+
+from hcc import as_of_date
+from hcc_compiled import lookup_model, member_fields
+from hcc_population import Population
+import hcc_metrics
+
+# Batch scoring.  Each model is a linear sum of coefficients over 0/1
+# indicator variables, so a population is scored by building one sparse
+# member x indicator matrix (CSR layout over the union of the community,
+# institutional and new enrollee variables) and taking its product with
+# one coefficient vector per model.
+
+class IndicatorMatrix:
+  def __init__(self,hicnos,indptr,indices,columns):
+    self.hicnos = hicnos
+    # row i holds the column ids indices[indptr[i]:indptr[i+1]]
+    self.indptr = indptr
+    self.indices = indices
+    self.columns = columns
+
+  @property
+  def shape(self):
+    return (len(self.indptr) - 1, len(self.columns))
+
+  def rows(self):
+    # the row id of every stored entry
+    return np.repeat(np.arange(self.shape[0]),np.diff(self.indptr))
+
+  def dot(self,vector):
+    return np.bincount(self.rows(),weights=vector[self.indices],
+                       minlength=self.shape[0]).astype(np.float64,copy=False)
+
+  def to_scipy(self):
+    from scipy.sparse import csr_matrix
+    data = np.ones(len(self.indices),dtype=np.int8)
+    return csr_matrix((data,self.indices,self.indptr),shape=self.shape)
+
+def ages_as_of(dobs,as_of=None):
+  # hcc.age_as_of for a whole column of dates of birth at once: YYYYMMDD
+  # strings or integers, or datetime64 values
+  as_of = as_of_date(as_of)
+  dobs = np.asarray(dobs)
+  if dobs.dtype.kind == "M":
+    days = dobs.astype("M8[D]")
+    if np.isnat(days).any():
+      raise ValueError("dates of birth must be YYYYMMDD")
+    months = days.astype("M8[M]")
+    years = days.astype("M8[Y]").astype(np.int64) + 1970
+    month_day = ((months.astype(np.int64) % 12 + 1) * 100 +
+                 (days - months.astype("M8[D]")).astype(np.int64) + 1)
+  else:
+    dates = dobs.astype(np.int64)
+    years, month_day = dates // 10000, dates % 10000
+    month, day = month_day // 100, month_day % 100
+    if ((month < 1) | (month > 12) | (day < 1) | (day > 31)).any():
+      raise ValueError("dates of birth must be YYYYMMDD")
+  return (as_of.year - years -
+          (as_of.month * 100 + as_of.day < month_day)).astype(np.int64)
+
+def with_ages(members,as_of=None,chunk_size=65536):
+  # yields the members with the age on as_of of every dict that only has a
+  # dob, computed a chunk at a time; Beneficiary objects pass unchanged
+  from hcc_stream import chunked
+  as_of = as_of_date(as_of)
+  for chunk in chunked(members,chunk_size):
+    dated = [i for i, m in enumerate(chunk)
+             if isinstance(m,dict) and m.get("age") is None]
+    if dated:
+      ages = ages_as_of([chunk[i]["dob"] for i in dated],as_of)
+      for i, age in zip(dated,ages.tolist()):
+        chunk[i] = dict(chunk[i],age=age)
+    for member in chunk:
+      yield member
+
+def member_indicators(members,model,as_of=None):
+  # (hicno, indicators) of each member; a Population is scored from its
+  # code ids
+  if isinstance(members,Population):
+    return members.indicators(model)
+  return ((hicno,model.indicators(sex,age,orec,medicaid,diagnoses))
+          for hicno, sex, age, orec, medicaid, diagnoses
+          in map(member_fields,with_ages(members,as_of)))
+
+def indicator_matrix(members,model=None,as_of=None):
+  # as_of is the date ages are taken on for members given by dob, e.g.
+  # hcc.payment_year_as_of(2017); today if left out
+  model = lookup_model(model)
+  columns = model.allvars
+  column_ids = dict((col,i) for i, col in enumerate(columns))
+  hicnos, indptr, indices = [], [0], []
+  for hicno, inds in member_indicators(members,model,as_of):
+    hicnos.append(hicno)
+    indices.extend(sorted(column_ids[ind] for ind in inds if ind in column_ids))
+    indptr.append(len(indices))
+  return IndicatorMatrix(np.array(hicnos,dtype=object),
+                         np.array(indptr,dtype=np.int64),
+                         np.array(indices,dtype=np.int32),
+                         columns)
+
+def coefficient_vectors(columns,model=None):
+  # model name -> coefficient of every column, 0 for variables outside it
+  model = lookup_model(model)
+  vectors = {}
+  for name, (prefix, reg_vars) in model.regressions.items():
+    vector = np.zeros(len(columns))
+    for i, col in enumerate(columns):
+      if col in reg_vars:
+        vector[i] = sum(model.coefficients.get(prefix + col,()))
+    vectors[name] = vector
+  return vectors
+
+def score_matrix(matrix,model=None):
+  metrics = hcc_metrics.current
+  scores = {"hicno":matrix.hicnos}
+  for name, vector in coefficient_vectors(matrix.columns,model).items():
+    if metrics is None:
+      scores[name] = matrix.dot(vector)
+      continue
+    with metrics.stage("batch_sum",name):
+      scores[name] = matrix.dot(vector)
+  return scores
+
+def score_batch(members,model=None,as_of=None):
+  # {'hicno': array, 'community': array, 'institutional': array,
+  #  'new_enrollee': array}; a member none of whose indicators belong to a
+  # model scores 0.0 there, where output(B,Col,Val) has no score row
+  return score_matrix(indicator_matrix(members,model,as_of),model)
+
+def to_dataframe(scores):
+  import pandas as pd
+  return pd.DataFrame(scores).set_index("hicno")
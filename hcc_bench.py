@@ -0,0 +1,271 @@
+from datetime import datetime
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+# Benchmarks.  `python hcc_bench.py` measures cold-start times and scoring
+# throughput, per-member latency and peak RSS for seeded synthetic
+# populations (hcc_synthetic) of each size, and writes the results as JSON
+# so runs from different commits can be compared with --compare.  --soak
+# checks that datalog scoring stays flat over many batches, and fails if it
+# does not (see soak_failures).
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# each cold start runs in a fresh interpreter
+COLD_STARTS = [
+  ("import hcc", "import hcc"),
+  ("import hcc + datalog load", "import hcc; hcc.load()"),
+  ("import hcc_compiled + compile", "import hcc_compiled; hcc_compiled.default_model()"),
+]
+
+ENGINES = ["compiled", "batch", "datalog"]
+SIZES = [1000, 100000, 1000000]
+# the datalog engine takes a fraction of a second per member
+DATALOG_MAX = 1000
+BATCH_SIZE = 10000
+
+def cold_start_time(statement):
+  code = ("import time; t = time.perf_counter(); %s; "
+          "print(time.perf_counter() - t)" % statement)
+  out = subprocess.check_output([sys.executable,"-c",code],cwd=HERE)
+  return float(out.decode().strip().splitlines()[-1])
+
+def import_times(repeat=5):
+  # name -> median seconds
+  return dict((name,statistics.median(cold_start_time(statement)
+                                      for _ in range(repeat)))
+              for name, statement in COLD_STARTS)
+
+def percentile(values,p):
+  values = sorted(values)
+  if not values:
+    return 0.0
+  return values[min(len(values) - 1,int(round(p / 100.0 * (len(values) - 1))))]
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on linux and bytes on macOS
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+def run(engine,size,seed=0):
+  # scores `size` synthetic members with one engine in this process; the
+  # members are generated lazily, so memory reflects the engine alone, and
+  # only the scoring calls are timed, not the generator
+  from hcc_synthetic import synthetic_members, synthetic_beneficiaries
+  latencies = []
+  elapsed = 0.0
+  clock = time.perf_counter
+  if engine == "compiled":
+    from hcc_compiled import default_model
+    model = default_model()
+    for member in synthetic_members(size,seed):
+      t = clock()
+      model.member_output(member)
+      latencies.append(clock() - t)
+    elapsed = sum(latencies)
+  elif engine == "batch":
+    from hcc_batch import score_batch
+    from hcc_stream import chunked
+    score_batch([])
+    for chunk in chunked(synthetic_members(size,seed),BATCH_SIZE):
+      t = clock()
+      score_batch(chunk)
+      seconds = clock() - t
+      elapsed += seconds
+      latencies.append(seconds / len(chunk))
+  elif engine == "datalog":
+    from hcc import beneficiary_output
+    for b in synthetic_beneficiaries(size,seed):
+      t = clock()
+      beneficiary_output(b)
+      latencies.append(clock() - t)
+    elapsed = sum(latencies)
+  else:
+    raise ValueError("unknown engine: " + str(engine))
+  # batch latencies are per-member averages over each chunk
+  return {"engine":engine, "size":size, "seed":seed,
+          "seconds":elapsed,
+          "members_per_second":size / elapsed if elapsed else 0.0,
+          "p50_ms":percentile(latencies,50) * 1000,
+          "p99_ms":percentile(latencies,99) * 1000,
+          "peak_rss_mb":peak_rss_mb()}
+
+def current_rss_mb():
+  try:
+    with open("/proc/self/statm") as f:
+      pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / (1024.0 * 1024.0)
+  except OSError:
+    return peak_rss_mb()
+
+SOAK_ROUNDS = 40
+SOAK_BATCH = 5
+
+def soak(rounds=SOAK_ROUNDS,batch_size=SOAK_BATCH,session=True,seed=0):
+  # scores `rounds` batches with the datalog rules and records, per round,
+  # the latency, the number of members and diagnoses in the datalog store,
+  # the number of live python objects and RSS.  With session=False the
+  # members are kept alive and stay in the store, as in a service without
+  # hcc.ScoringSession.
+  from hcc import ScoringSession, Beneficiary, Diagnosis
+  from hcc_synthetic import synthetic_members
+  from pyDatalog.pyDatalog import metaMixin
+  kept = []
+  stats = []
+  for r in range(rounds):
+    members = list(synthetic_members(batch_size,seed + r))
+    t = time.perf_counter()
+    if session:
+      with ScoringSession() as scoring:
+        scoring.score(members)
+    else:
+      scoring = ScoringSession()
+      scoring.score(members)
+      kept.extend(scoring.beneficiaries)
+    elapsed = time.perf_counter() - t
+    gc.collect()
+    stats.append({"round":r,
+                  "ms_per_member":elapsed / batch_size * 1000,
+                  "store":len(metaMixin.__refs__[Beneficiary]) +
+                          len(metaMixin.__refs__[Diagnosis]),
+                  "objects":len(gc.get_objects()),
+                  "rss_mb":current_rss_mb()})
+  return stats
+
+def soak_failures(stats,session=True,warmup=5,latency_growth=0.25,rss_growth_mb=4.0,
+                  object_growth=200):
+  # reasons a soak did not stay flat: facts left in the store after a
+  # session, or the median store size, latency, RSS or live object count of
+  # the later half of the rounds after warmup rising above the earlier half
+  # (by more than the given tolerances; the store may not grow at all)
+  failures = []
+  if session:
+    failures.extend("round %d left %d facts in the datalog store" % (r["round"],r["store"])
+                    for r in stats if r["store"])
+  steady = stats[warmup:]
+  if len(steady) < 4:
+    return failures + ["%d rounds are too few to show a trend after %d warm-up rounds" %
+                       (len(stats),warmup)]
+  half = len(steady) // 2
+  def medians(key):
+    return (statistics.median(r[key] for r in steady[:half]),
+            statistics.median(r[key] for r in steady[-half:]))
+  early, late = medians("store")
+  if late > early:
+    failures.append("the datalog store grew from %d to %d facts" % (early,late))
+  early, late = medians("ms_per_member")
+  if late > early * (1 + latency_growth):
+    failures.append("latency rose from %.1f to %.1f ms/member" % (early,late))
+  early, late = medians("rss_mb")
+  if late - early > rss_growth_mb:
+    failures.append("RSS rose from %.1f to %.1f MB" % (early,late))
+  early, late = medians("objects")
+  if late - early > object_growth:
+    failures.append("live objects rose from %d to %d" % (early,late))
+  return failures
+
+def run_isolated(engine,size,seed=0):
+  out = subprocess.check_output([sys.executable,os.path.abspath(__file__),
+                                 "--run",engine,str(size),"--seed",str(seed)],
+                                cwd=HERE)
+  return json.loads(out.decode().strip().splitlines()[-1])
+
+def git_commit():
+  try:
+    out = subprocess.check_output(["git","rev-parse","HEAD"],cwd=HERE,
+                                  stderr=subprocess.DEVNULL)
+    return out.decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def benchmark(sizes=SIZES,engines=ENGINES,seed=0,datalog_max=DATALOG_MAX):
+  runs = []
+  for engine in engines:
+    for size in sizes:
+      if engine == "datalog" and size > datalog_max:
+        continue
+      runs.append(run_isolated(engine,size,seed))
+  return {"commit":git_commit(),
+          "timestamp":datetime.now().isoformat(),
+          "python":platform.python_version(),
+          "platform":platform.platform(),
+          "import_seconds":import_times(),
+          "runs":runs}
+
+def compare(old,new):
+  # lines of relative change, new against old, for every run in both
+  lines = []
+  for name, seconds in new["import_seconds"].items():
+    if name in old["import_seconds"]:
+      lines.append("%-36s %+7.1f%%" % ("import: " + name,
+                   100.0 * (seconds / old["import_seconds"][name] - 1)))
+  before = dict(((r["engine"],r["size"]),r) for r in old["runs"])
+  for r in new["runs"]:
+    o = before.get((r["engine"],r["size"]))
+    if o is None:
+      continue
+    for metric in ("members_per_second","p50_ms","p99_ms","peak_rss_mb"):
+      if o[metric]:
+        lines.append("%-36s %+7.1f%%" % ("%s %d %s" % (r["engine"],r["size"],metric),
+                     100.0 * (r[metric] / o[metric] - 1)))
+  return lines
+
+def report(results):
+  lines = ["%-32s %8.1f ms" % (name,seconds * 1000)
+           for name, seconds in results["import_seconds"].items()]
+  lines.append("%-9s %9s %12s %9s %9s %9s" % ("engine","members","members/s",
+                                               "p50 ms","p99 ms","rss MB"))
+  for r in results["runs"]:
+    lines.append("%-9s %9d %12.0f %9.3f %9.3f %9.1f" % (
+      r["engine"],r["size"],r["members_per_second"],r["p50_ms"],r["p99_ms"],
+      r["peak_rss_mb"]))
+  return lines
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="HCC scoring benchmarks")
+  parser.add_argument("--sizes",type=int,nargs="+",default=SIZES)
+  parser.add_argument("--engines",nargs="+",choices=ENGINES,default=ENGINES)
+  parser.add_argument("--seed",type=int,default=0)
+  parser.add_argument("--datalog-max",type=int,default=DATALOG_MAX)
+  parser.add_argument("--output",help="write the results as JSON to this file")
+  parser.add_argument("--compare",nargs=2,metavar=("OLD","NEW"),
+                      help="compare two result files instead of running")
+  parser.add_argument("--soak",type=int,nargs="?",const=SOAK_ROUNDS,metavar="ROUNDS",
+                      help="run a datalog soak of ROUNDS batches (default %d) instead, "
+                           "failing unless it stays flat" % SOAK_ROUNDS)
+  parser.add_argument("--soak-batch",type=int,default=SOAK_BATCH,
+                      help="members per soak batch")
+  parser.add_argument("--no-session",action="store_true",
+                      help="soak without retracting scored members")
+  parser.add_argument("--run",nargs=2,metavar=("ENGINE","SIZE"),
+                      help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run:
+    print(json.dumps(run(args.run[0],int(args.run[1]),args.seed)))
+  elif args.soak:
+    session = not args.no_session
+    stats = soak(args.soak,args.soak_batch,session,args.seed)
+    for r in stats:
+      print("round %(round)3d %(ms_per_member)9.1f ms/member %(store)7d facts "
+            "%(objects)9d objects %(rss_mb)8.1f MB" % r)
+    failures = soak_failures(stats,session)
+    print("\n".join(failures) or "flat")
+    sys.exit(1 if failures else 0)
+  elif args.compare:
+    with open(args.compare[0]) as old, open(args.compare[1]) as new:
+      print("\n".join(compare(json.load(old),json.load(new))))
+  else:
+    results = benchmark(args.sizes,args.engines,args.seed,args.datalog_max)
+    print("\n".join(report(results)))
+    if args.output:
+      with open(args.output,"w") as f:
+        json.dump(results,f,indent=2)
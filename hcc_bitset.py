@@ -0,0 +1,113 @@
+# Bitset form of the hierarchy and interaction rules.  Every CC that an
+# indicator can depend on (the hccees, hierarchy, diagnostic categories,
+# interaction groups and DISABLED HCCs) has a fixed bit position, hccees first
+# in their listed order.  A member's CCs are then one integer:
+#
+#   beneficiary_has_hcc      ccs & ~(OR of suppression[c] for each overrider c)
+#   interaction(X,G1,G2)     (hccs & group[G1]) and (hccs & group[G2])
+#
+# pack() lays a population out as an (n, words) uint64 array, 16 bytes per
+# member for the 87 V21 CCs, and population_hccs/population_interactions
+# apply the same masks to a whole population with NumPy.
+
+WORD_BITS = 64
+
+class HccBits:
+  def __init__(self,hccees,hierarchy,interactions,disabled_hccs):
+    # hierarchy is (overrider, overridees) pairs; interactions are
+    # (name, first CC set, second CC set) as in CompiledModel.interactions
+    order = list(hccees)
+    for overrider, overridees in hierarchy:
+      order.append(overrider)
+      order.extend(overridees)
+    for _, first, second in interactions:
+      order.extend(sorted(first))
+      order.extend(sorted(second))
+    order.extend(disabled_hccs)
+    self.order = []
+    self.position = {}
+    for c in order:
+      if c not in self.position:
+        self.position[c] = len(self.order)
+        self.order.append(c)
+    self.words = max(1,(len(self.order) + WORD_BITS - 1) // WORD_BITS)
+
+    # overrider bit -> mask of the CCs it suppresses
+    self.suppression = {}
+    for overrider, overridees in hierarchy:
+      bit = self.mask([overrider])
+      self.suppression[bit] = self.suppression.get(bit,0) | self.mask(overridees)
+    self.overriders = self.mask(c for c in self.order
+                                if self.mask([c]) in self.suppression)
+    self.interactions = [(name,self.mask(first),self.mask(second))
+                         for name, first, second in interactions]
+    self.hccees = self.mask(hccees)
+    self.disabled = self.mask(disabled_hccs)
+
+  def mask(self,ccs):
+    # CCs no indicator depends on have no position and are left out
+    mask = 0
+    for c in ccs:
+      i = self.position.get(c)
+      if i is not None:
+        mask |= 1 << i
+    return mask
+
+  def ccs(self,mask):
+    ccs = []
+    while mask:
+      low = mask & -mask
+      ccs.append(self.order[low.bit_length() - 1])
+      mask ^= low
+    return ccs
+
+  def hcc_mask(self,ccs):
+    # beneficiary_has_hcc(B,CC) from the beneficiary_has_cc(B,CC) mask
+    suppressed = 0
+    present = ccs & self.overriders
+    while present:
+      low = present & -present
+      suppressed |= self.suppression[low]
+      present ^= low
+    return ccs & ~suppressed
+
+  def indicators(self,hccs,disabled):
+    # same as CompiledModel.hcc_indicators on the unpacked HCC set
+    inds = set("HCC" + c for c in self.ccs(hccs & self.hccees))
+    if disabled:
+      inds.update("DISABLED_HCC" + c for c in self.ccs(hccs & self.disabled))
+    for name, first, second in self.interactions:
+      if (hccs & first) and (hccs & second):
+        inds.add(name)
+    return inds
+
+  def split(self,mask):
+    # the uint64 words of one mask, lowest first
+    return [(mask >> (WORD_BITS * w)) & 0xFFFFFFFFFFFFFFFF
+            for w in range(self.words)]
+
+  def pack(self,masks):
+    import numpy as np
+    return np.array([self.split(m) for m in masks],dtype=np.uint64).reshape(-1,self.words)
+
+  def unpack(self,packed):
+    return [sum(int(word) << (WORD_BITS * w) for w, word in enumerate(row))
+            for row in packed]
+
+  def population_hccs(self,packed):
+    # hcc_mask for every row of a packed CC population
+    import numpy as np
+    hccs = packed.copy()
+    for bit, suppressed in self.suppression.items():
+      w, b = divmod(bit.bit_length() - 1,WORD_BITS)
+      has = (packed[:,w] >> np.uint64(b)) & np.uint64(1) == 1
+      hccs[has] &= ~np.array(self.split(suppressed),dtype=np.uint64)
+    return hccs
+
+  def population_interactions(self,packed):
+    # interaction name -> boolean array over the rows of packed HCCs
+    import numpy as np
+    def any_of(mask):
+      return (packed & np.array(self.split(mask),dtype=np.uint64)).any(axis=1)
+    return dict((name,any_of(first) & any_of(second))
+                for name, first, second in self.interactions)
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+import threading
+
+from hcc_compiled import lookup_model, member_fields
+import hcc_metrics
+
+# Opt-in memoization of compiled scoring results.  Members that share a
+# demographic cell and the same distinct (icdcode, codetype) pairs get the
+# same indicators, scores and output rows, so those are computed once and
+# kept in a size-bounded LRU cache.
+#
+# Ages are keyed by class rather than by value: two ages fall in the same
+# class when they give the same demographic indicators, the same disabled
+# status and the same side of every CC edit/excision age limit.  Only the
+# ('age', A) output row differs between them, and it is added on the way out.
+#
+# ScoreCache wraps a CompiledModel and offers the same scoring methods, so
+# it can be passed as the model to hcc_batch, hcc_stream and friends.  It
+# may be shared between threads.
+
+class ScoreCache:
+  def __init__(self,model=None,maxsize=100000):
+    self.model = lookup_model(model)
+    self.maxsize = maxsize
+    self.entries = OrderedDict()
+    self.age_classes = {}
+    self.age_limits = sorted(set(
+        [max_age for edits in self.model.edits.values()
+                 for _, sexE, max_age in edits if sexE is None] +
+        list(self.model.excisions.values())))
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def __getattr__(self,name):
+    # everything else (regressions, coefficients, allvars, ...) is the model's
+    if name == "model":
+      raise AttributeError(name)
+    return getattr(self.model,name)
+
+  def age_class(self,sex,age,orec,medicaid):
+    key = (sex,age,orec,medicaid)
+    cls = self.age_classes.get(key)
+    if cls is None:
+      cls = self.age_classes[key] = (
+        frozenset(self.model.demographic_indicators(sex,age,orec,medicaid)),
+        age < 65 and orec != 0,
+        tuple(age < limit for limit in self.age_limits))
+    return cls
+
+  def key(self,engine,sex,age,orec,medicaid,diagnoses):
+    return (engine,sex,self.age_class(sex,age,int(orec),medicaid == True),
+            tuple(sorted(set((icd,int(codetype)) for icd, codetype in diagnoses))))
+
+  def get(self,key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.hits += 1
+        self.entries.move_to_end(key)
+      else:
+        self.misses += 1
+    metrics = hcc_metrics.current
+    if metrics is not None:
+      metrics.count("cache_hits" if entry is not None else "cache_misses")
+      if entry is not None:
+        # a miss is counted when the model scores the member
+        metrics.member()
+    return entry
+
+  def put(self,key,entry):
+    with self.lock:
+      self.entries[key] = entry
+      if len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+      return entry
+
+  def lookup(self,sex,age,orec,medicaid,diagnoses):
+    # (indicators, scores, output rows without sex and age)
+    key = self.key("compiled",sex,age,orec,medicaid,diagnoses)
+    entry = self.get(key)
+    if entry is None:
+      inds = frozenset(self.model.indicators(sex,age,orec,medicaid,diagnoses))
+      rows = self.model.indicator_output(inds,sex,age)[:-2]
+      entry = self.put(key,(inds,self.model.scores(inds),tuple(rows)))
+    return entry
+
+  def beneficiary_output(self,b,engine="compiled"):
+    # output rows for a Beneficiary from either engine; datalog results are
+    # cached under their own keys
+    if engine != "datalog":
+      return self.member_output(b)
+    from hcc import beneficiary_output
+    _, sex, age, orec, medicaid, diagnoses = member_fields(b)
+    key = self.key(engine,sex,age,orec,medicaid,diagnoses)
+    rows = self.get(key)
+    if rows is None:
+      rows = self.put(key,tuple(row for row in beneficiary_output(b,engine)
+                                if row[0] not in ("sex","age")))
+    return list(rows) + [("sex",sex),("age",age)]
+
+  def indicators(self,sex,age,orec,medicaid,diagnoses):
+    return set(self.lookup(sex,age,orec,medicaid,diagnoses)[0])
+
+  def output(self,sex,age,orec,medicaid,diagnoses):
+    rows = list(self.lookup(sex,age,orec,medicaid,diagnoses)[2])
+    rows.append(("sex",sex))
+    rows.append(("age",age))
+    return rows
+
+  def sparse_output(self,sex,age,orec,medicaid,diagnoses):
+    inds, scores, _ = self.lookup(sex,age,orec,medicaid,diagnoses)
+    return list(scores.items()) + [(col,1) for col in sorted(inds)]
+
+  def member_indicators(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return self.indicators(sex,age,orec,medicaid,diagnoses)
+
+  def member_output(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return self.output(sex,age,orec,medicaid,diagnoses)
+
+  def member_sparse_output(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return self.sparse_output(sex,age,orec,medicaid,diagnoses)
+
+  def member_scores(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return dict(self.lookup(sex,age,orec,medicaid,diagnoses)[1])
+
+  def info(self):
+    lookups = self.hits + self.misses
+    return {"hits":self.hits, "misses":self.misses,
+            "hit_rate":self.hits / lookups if lookups else 0.0,
+            "size":len(self.entries), "maxsize":self.maxsize}
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.hits = self.misses = 0
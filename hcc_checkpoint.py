@@ -0,0 +1,269 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import time
+
+import numpy as np
+
+from hcc import as_of_date, payment_year_as_of
+from hcc_batch import coefficient_vectors, indicator_matrix
+from hcc_compiled import DEFAULT_VERSION, file_digest, get_model, model_spec
+from hcc_output import wide_dtype, wide_rows
+from hcc_stream import chunked
+
+# Checkpointed population runs.  Members are scored in numbered chunks of
+# chunk_size, and every chunk is written to the run directory as
+#
+#   chunk-000042.npy    the chunk's wide rows (see hcc_output), and then
+#   chunk-000042.json   its record: input offset, rows, model version and
+#                       reference digest
+#
+# each to a temporary file renamed into place, so a chunk is either
+# complete or absent.  manifest.json fixes the version, reference digest,
+# chunk size and as-of date of the run; a restart skips every chunk with a
+# record and refuses a manifest that does not match.  Several processes or
+# machines sharing the directory split the work: a chunk is claimed by
+# creating chunk-000042.lock exclusively.  A lock of this host is taken over
+# once its process is gone, and a lock of another host once it is older than
+# stale_after seconds, so stale_after must exceed the time a chunk takes.
+# Every worker must read the same member input in the same order.
+
+MANIFEST = "manifest.json"
+COMPLETE = "complete.json"
+
+def _canonical(value):
+  # tables as JSON-able values whose order does not depend on set order
+  if isinstance(value,(set,frozenset)):
+    return sorted(_canonical(v) for v in value)
+  if isinstance(value,dict):
+    return sorted([str(k),_canonical(v)] for k, v in value.items())
+  if isinstance(value,(list,tuple)):
+    return [_canonical(v) for v in value]
+  return value
+
+def reference_digest(version=None):
+  # sha256 of a version's ICD and coefficient files and its rule tables
+  spec = model_spec(version)
+  digest = hashlib.sha256()
+  digest.update(file_digest([f for f, _ in spec.icd_files] +
+                            [spec.coefficient_file]).encode())
+  digest.update(json.dumps(_canonical([spec.icd_files,spec.hierarchy,spec.categories,
+                                       spec.edits,spec.excisions,spec.hccees,
+                                       spec.regressions,spec.interaction_terms,
+                                       spec.disabled_hccs])).encode())
+  return digest.hexdigest()
+
+def _worker():
+  return "%s.%d" % (socket.gethostname(),os.getpid())
+
+def _atomic_write(path,write):
+  # write(file) to a temporary file of this process, renamed to path
+  tmp = "%s.%s.tmp" % (path,_worker())
+  with open(tmp,"wb") as file:
+    write(file)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(tmp,path)
+
+def _write_json(path,record):
+  _atomic_write(path,lambda file: file.write(json.dumps(record,indent=1).encode()))
+
+def _read_json(path):
+  with open(path) as file:
+    return json.load(file)
+
+def chunk_path(directory,n,suffix):
+  return os.path.join(directory,"chunk-%06d.%s" % (n,suffix))
+
+def open_manifest(directory,version=None,chunk_size=10000,as_of=None,hicno_width=16):
+  # the manifest of the run in directory, created if there is none yet
+  version = version or DEFAULT_VERSION
+  manifest = {"version":version,
+              "reference":reference_digest(version),
+              "chunk_size":chunk_size,
+              "as_of":as_of_date(as_of).strftime("%Y%m%d"),
+              "hicno_width":hicno_width}
+  path = os.path.join(directory,MANIFEST)
+  if not os.path.exists(path):
+    # link() creates path only if no other worker has, unlike rename()
+    tmp = "%s.%s.tmp" % (path,_worker())
+    with open(tmp,"w") as file:
+      json.dump(dict(manifest,created=time.time()),file,indent=1)
+    try:
+      os.link(tmp,path)
+    except FileExistsError:
+      pass
+    finally:
+      os.unlink(tmp)
+  existing = _read_json(path)
+  for key in ("version","reference","chunk_size","hicno_width"):
+    if existing[key] != manifest[key]:
+      raise ValueError("%s was started with %s %r, not %r" %
+                       (directory,key,existing[key],manifest[key]))
+  if as_of is not None and existing["as_of"] != manifest["as_of"]:
+    raise ValueError("%s was started with as_of %s, not %s" %
+                     (directory,existing["as_of"],manifest["as_of"]))
+  return existing
+
+def _read_lock(lock):
+  # the contents of lock, "host pid time", or None once it is gone
+  try:
+    with open(lock) as file:
+      return file.read()
+  except FileNotFoundError:
+    return None
+
+def _stale(lock,stale_after):
+  # the contents of lock if it may be taken over, else None: a lock of this
+  # host is stale once its process is gone, and never while it runs; a lock
+  # of another host once it is older than stale_after seconds
+  try:
+    with open(lock) as file:
+      owner = file.read()
+    age = time.time() - os.stat(lock).st_mtime
+    host, pid = owner.split()[:2]
+    pid = int(pid)
+  except (OSError,ValueError):
+    return None
+  if host == socket.gethostname():
+    try:
+      os.kill(pid,0)
+    except ProcessLookupError:
+      return owner
+    except OSError:
+      pass
+    return None
+  return owner if age > stale_after else None
+
+def _claim(lock,stale_after):
+  # the contents of lock if this process now holds it, else None
+  for _ in range(2):
+    try:
+      fd = os.open(lock,os.O_CREAT | os.O_EXCL | os.O_WRONLY,0o644)
+    except FileExistsError:
+      owner = _stale(lock,stale_after)
+      if owner is None:
+        return None
+      # only one of the workers taking over a stale lock renames it away,
+      # and the lock it moved may be a fresh one created since it looked
+      stale = "%s.%s.stale" % (lock,_worker())
+      try:
+        os.rename(lock,stale)
+      except FileNotFoundError:
+        return None
+      if _read_lock(stale) != owner:
+        # put the fresh lock back, unless yet another one has been created
+        try:
+          os.link(stale,lock)
+        except FileExistsError:
+          pass
+        os.unlink(stale)
+        return None
+      os.unlink(stale)
+      continue
+    owner = "%s %d %f\n" % (socket.gethostname(),os.getpid(),time.time())
+    with os.fdopen(fd,"w") as file:
+      file.write(owner)
+    return owner
+  return None
+
+def _release(lock,owner):
+  # removes lock if it is still this process's, and tolerates it being gone
+  if _read_lock(lock) == owner:
+    try:
+      os.unlink(lock)
+    except FileNotFoundError:
+      pass
+
+def run_checkpointed(members,directory,version=None,chunk_size=10000,as_of=None,
+                     hicno_width=16,stale_after=3600):
+  # scores every chunk of members without a record in directory; returns
+  # {'scored': chunks scored here, 'done': chunks already done, 'busy':
+  #  chunks being scored by another worker}
+  os.makedirs(directory,exist_ok=True)
+  manifest = open_manifest(directory,version,chunk_size,as_of,hicno_width)
+  version, as_of = manifest["version"], as_of_date(manifest["as_of"])
+  model = get_model(version)
+  dtype = wide_dtype(model,hicno_width)
+  vectors = coefficient_vectors(model.allvars,model)
+  counts = {"scored":0, "done":0, "busy":0}
+  n = -1
+  for n, chunk in enumerate(chunked(members,chunk_size)):
+    record = chunk_path(directory,n,"json")
+    if os.path.exists(record):
+      counts["done"] += 1
+      continue
+    lock = chunk_path(directory,n,"lock")
+    owner = _claim(lock,stale_after)
+    if owner is None:
+      counts["busy"] += 1
+      continue
+    try:
+      if os.path.exists(record):
+        counts["done"] += 1
+        continue
+      start = time.perf_counter()
+      rows = wide_rows(indicator_matrix(chunk,model,as_of),vectors,dtype)
+      _atomic_write(chunk_path(directory,n,"npy"),lambda file: np.save(file,rows))
+      _write_json(record,{"chunk":n,
+                          "offset":n * chunk_size,
+                          "rows":len(rows),
+                          "version":version,
+                          "reference":manifest["reference"],
+                          "worker":_worker(),
+                          "seconds":time.perf_counter() - start})
+      counts["scored"] += 1
+    finally:
+      _release(lock,owner)
+  # every worker that reads the whole input agrees on the chunk count
+  _write_json(os.path.join(directory,COMPLETE),{"chunks":n + 1})
+  return counts
+
+def status(directory):
+  # {'chunks': total once known, else None, 'done': [...], 'locked': [...]}
+  names = os.listdir(directory)
+  def numbers(suffix):
+    return sorted(int(name[6:12]) for name in names
+                  if name.startswith("chunk-") and name.endswith("." + suffix))
+  complete = os.path.join(directory,COMPLETE)
+  return {"chunks":_read_json(complete)["chunks"] if os.path.exists(complete) else None,
+          "done":numbers("json"),
+          "locked":numbers("lock")}
+
+def read_results(directory,mmap_mode=None):
+  # the wide rows of a finished run, in input order
+  state = status(directory)
+  if state["chunks"] is None or state["done"] != list(range(state["chunks"])):
+    total = " of %d" % state["chunks"] if state["chunks"] is not None else ""
+    raise ValueError("%s is not finished: %d%s chunks done" %
+                     (directory,len(state["done"]),total))
+  manifest = _read_json(os.path.join(directory,MANIFEST))
+  parts = [np.load(chunk_path(directory,n,"npy"),mmap_mode=mmap_mode)
+           for n in range(state["chunks"])]
+  if not parts:
+    return np.zeros(0,dtype=wide_dtype(manifest["version"],manifest["hicno_width"]))
+  return np.concatenate(parts)
+
+if __name__ == "__main__":
+  from hcc_stream import stream_members
+  parser = argparse.ArgumentParser(description="checkpointed, resumable HCC scoring run")
+  parser.add_argument("directory",help="run directory, shared by every worker")
+  parser.add_argument("members",help="member file (see hcc_stream)")
+  parser.add_argument("diagnoses",help="diagnosis file (see hcc_stream)")
+  parser.add_argument("--version",help="registered model version")
+  parser.add_argument("--chunk-size",type=int,default=10000)
+  parser.add_argument("--payment-year",type=int,
+                      help="age members as of February 1 of this year")
+  parser.add_argument("--stale-after",type=float,default=3600,
+                      help="seconds after which another worker's lock is taken over")
+  args = parser.parse_args()
+  as_of = payment_year_as_of(args.payment_year) if args.payment_year else None
+  # members are aged on the as-of date the run was started with
+  os.makedirs(args.directory,exist_ok=True)
+  as_of = open_manifest(args.directory,args.version,args.chunk_size,as_of)["as_of"]
+  counts = run_checkpointed(stream_members(args.members,args.diagnoses,as_of),
+                            args.directory,args.version,args.chunk_size,as_of,
+                            stale_after=args.stale_after)
+  print("%(scored)d chunks scored, %(done)d already done, %(busy)d busy" % counts)
@@ -0,0 +1,620 @@
+from array import array
+from collections import defaultdict
+from datetime import datetime
+import hashlib
+import os
+import sys
+import threading
+import time
+
+from hcc import (EntitlementReason, Beneficiary, age_as_of, as_of_date, read_cc_facts,
+                 read_coefficients, hcc_hierarchy, diagnostic_categories, cc_edits, cc_excisions,
+                 hcc_codes, community_regression, institutional_regression,
+                 new_enrollee_regression)
+from hcc_bitset import HccBits
+import hcc_metrics
+from hcc_refcache import open_reference
+
+# The compiled engine evaluates the same facts and rules as hcc.load_rules(),
+# but against plain python dicts and sets built once up front.  Every rule
+# below names the datalog rule it stands in for, and the two engines must
+# produce the same output(B,Col,Val) rows (see compare_engines below).
+
+# (indicator, lower, upper) as used by sex_age_range; upper of -1.0 is open
+AGE_RANGES = [("0_34",0,34), ("35_44",35,44), ("45_54",45,54),
+              ("55_59",55,59), ("60_64",60,64), ("65_69",65,69),
+              ("70_74",70,74), ("75_79",75,79), ("80_84",80,84),
+              ("85_89",85,89), ("90_94",90,94), ("95_GT",95,-1.0)]
+
+DISABLED_HCCS = ["110","161","176","34","39","46","54","55","6","77","85"]
+
+def age_range(age,L,U):
+  # age_range(B,L,U) <= age(B,A) & (A <= U) & (A > L)
+  # age_range(B,L,-1.0) <= age(B,A) & (A > L)
+  return (L < age <= U) or (U == -1.0 and age > L)
+
+def sex_age_range(MF,sex,age,L,U):
+  return sex == MF and age_range(age,L,U)
+
+def sex_age(MF,sex,age,A):
+  # sex_age(MF,B,A) <= sex_age_range(MF,B,(A+1),A)
+  return sex_age_range(MF,sex,age,A+1,A)
+
+# (indicator, first CC group, second CC group) for every
+# indicator(B,X) <= ben_hcc(B,CC) & ben_hcc(B,CC2) & x(CC,CC2) rule; a group
+# is either a diagnostic category name or a list of CCs
+INTERACTION_TERMS = [
+  ("ART_OPENINGS_PRESSURE_ULCER", "pressure_ulcer", ["188"]),
+  ("ASP_SPEC_BACT_PNEUM_PRES_ULC", "pressure_ulcer", ["114"]),
+  ("CANCER_IMMUNE", "cancer", "immune"),
+  ("CHF_COPD", "chf", "copd"),
+  ("CHF_RENAL", "chf", "renal"),
+  ("COPD_ASP_SPEC_BACT_PNEUM", "copd", ["114"]),
+  ("COPD_CARD_RESP_FAIL", "copd", "card_resp_fail"),
+  ("DIABETES_CHF", "diabetes", "chf"),
+  ("SCHIZOPHRENIA_CHF", "chf", ["57"]),
+  ("SCHIZOPHRENIA_COPD", "copd", ["57"]),
+  ("SCHIZOPHRENIA_SEIZURES", ["79"], ["57"]),
+  ("SEPSIS_ARTIF_OPENINGS", "sepsis", ["188"]),
+  ("SEPSIS_ASP_SPEC_BACT_PNEUM", "sepsis", ["114"]),
+  ("SEPSIS_CARD_RESP_FAIL", "sepsis", "card_resp_fail")]
+
+def interactions(categories,terms=INTERACTION_TERMS):
+  def group(g):
+    if isinstance(g,str):
+      return categories.get(g,frozenset())
+    return frozenset(g)
+  return [(name,group(first),group(second)) for name, first, second in terms]
+
+SEXES = ["female","male"]
+MAX_AGE = 120
+
+class DemographicTable:
+  # The age/sex, Medicaid, originally disabled and new enrollee indicators
+  # depend on sex, age, OREC and Medicaid alone, so they are evaluated once
+  # for every cell: female/male x age 0-120 x OREC x Medicaid.  For each cell
+  # the table keeps the indicator set, the {model: score} of those
+  # indicators alone (as scores() gives it) and, per model, a dense array of
+  # the same sums with 0.0 for none.  The newenrollee_medicaid flag is not
+  # used by any indicator and is not part of the key.
+  def __init__(self,model):
+    self.orecs = len(EntitlementReason)
+    self.indicators = []
+    self.scores = []
+    self.sums = dict((name,array("d")) for name in model.regressions)
+    for sex in SEXES:
+      for age in range(MAX_AGE + 1):
+        for orec in EntitlementReason:
+          for medicaid in (False,True):
+            inds = frozenset(model.demographic_indicators(sex,age,orec,medicaid))
+            scores = model.scores(inds)
+            self.indicators.append(inds)
+            self.scores.append(scores)
+            for name, sums in self.sums.items():
+              sums.append(scores.get(name,0.0))
+
+  def index(self,sex,age,orec,medicaid):
+    # the cell of a member, or None outside the table
+    if sex not in SEXES or not 0 <= age <= MAX_AGE or not 0 <= orec < self.orecs:
+      return None
+    return (((SEXES.index(sex) * (MAX_AGE + 1) + age) * self.orecs + int(orec)) * 2 +
+            (medicaid == True))
+
+  def index_array(self,sex,age,orec,medicaid):
+    # index() over NumPy arrays, sex as positions in SEXES; -1 outside
+    import numpy as np
+    sex, age, orec = (np.asarray(a,dtype=np.int64) for a in (sex,age,orec))
+    medicaid = np.asarray(medicaid,dtype=np.int64)
+    inside = ((sex >= 0) & (sex < len(SEXES)) & (age >= 0) & (age <= MAX_AGE) &
+              (orec >= 0) & (orec < self.orecs))
+    index = ((sex * (MAX_AGE + 1) + age) * self.orecs + orec) * 2 + (medicaid != 0)
+    return np.where(inside,index,-1)
+
+class CompiledModel:
+  def __init__(self,cc_map,hierarchy,categories,edits,excisions,hccees,
+               coefficients,regressions,interaction_terms=INTERACTION_TERMS,
+               disabled_hccs=DISABLED_HCCS):
+    # (icd, codetype) -> tuple of CCs
+    self.cc_map = cc_map
+    # CC -> set of CCs that override it, and CC -> set of CCs it overrides
+    overridden_by = defaultdict(set)
+    overrides = defaultdict(set)
+    for overrider, overridees in hierarchy:
+      for overridee in overridees:
+        overridden_by[overridee].add(overrider)
+        overrides[overrider].add(overridee)
+    self.overridden_by = dict((c,frozenset(v)) for c, v in overridden_by.items())
+    self.overrides = dict((c,frozenset(v)) for c, v in overrides.items())
+    self.categories = categories
+    # (icd, codetype) -> [(CC, sex, age limit)]
+    self.edits = defaultdict(list)
+    for icdtype, ccE, sexE, max_age, icds in edits:
+      for icd in icds:
+        self.edits[(icd,icdtype)].append((ccE,sexE,max_age))
+    # (icd, codetype) -> age limit
+    self.excisions = {}
+    for icdtype, max_age, icds in excisions:
+      for icd in icds:
+        self.excisions[(icd,icdtype)] = max(max_age,self.excisions.get((icd,icdtype),max_age))
+    self.hccees = frozenset(hccees)
+    self.interactions = interactions(categories,interaction_terms)
+    # CC -> the interactions it takes part in
+    self.interactions_of = defaultdict(list)
+    for term in self.interactions:
+      for c in term[1] | term[2]:
+        self.interactions_of[c].append(term)
+    self.disabled_hccs = list(disabled_hccs)
+    # fixed bit positions, suppression and group masks (see hcc_bitset)
+    self.bits = HccBits(hccees,hierarchy,self.interactions,self.disabled_hccs)
+    # (icd, codetype) -> CC mask, for codes without edits or excisions
+    self.code_masks = {}
+    self._demographics = None
+    # label -> list of coefficients, as coefficient(label,Coef) is a relation
+    self.coefficients = coefficients
+    # model -> (coefficient prefix, variables)
+    self.regressions = regressions
+    self.allvars = sorted(set().union(*[v for _, v in regressions.values()]))
+
+  def code_ccs(self,sex,age,icd,codetype):
+    # the CCs one distinct (icd, codetype) gives a beneficiary
+    if age < self.excisions.get((icd,codetype),-1):
+      return ()
+    edited = [ccE for ccE, sexE, max_age in self.edits.get((icd,codetype),())
+              if (sexE is not None and sex == sexE) or
+                 (sexE is None and age < max_age)]
+    return edited or self.cc_map.get((icd,codetype),())
+
+  def ccs(self,sex,age,diagnoses):
+    # beneficiary_has_cc(B,CC)
+    ccs = set()
+    for icd, codetype in set((icd,int(codetype)) for icd, codetype in diagnoses):
+      ccs.update(self.code_ccs(sex,age,icd,codetype))
+    return ccs
+
+  def cc_mask(self,sex,age,diagnoses):
+    # ccs() as a bitset
+    if hcc_metrics.current is not None:
+      return self._profiled_cc_mask(sex,age,diagnoses,hcc_metrics.current)
+    mask = 0
+    for code in set((icd,int(codetype)) for icd, codetype in diagnoses):
+      if code in self.edits or code in self.excisions:
+        mask |= self.bits.mask(self.code_ccs(sex,age,*code))
+        continue
+      m = self.code_masks.get(code)
+      if m is None:
+        m = self.code_masks[code] = self.bits.mask(self.cc_map.get(code,()))
+      mask |= m
+    return mask
+
+  def _profiled_cc_mask(self,sex,age,diagnoses,metrics):
+    # cc_mask, timing the mapped and the edited/excised codes apart
+    clock = time.perf_counter
+    mask = 0
+    for code in set((icd,int(codetype)) for icd, codetype in diagnoses):
+      t = clock()
+      if code in self.edits or code in self.excisions:
+        mask |= self.bits.mask(self.code_ccs(sex,age,*code))
+        metrics.record("edits",clock() - t)
+        continue
+      m = self.code_masks.get(code)
+      if m is None:
+        m = self.code_masks[code] = self.bits.mask(self.cc_map.get(code,()))
+      mask |= m
+      metrics.record("cc_map",clock() - t)
+    return mask
+
+  def hccs(self,ccs):
+    # beneficiary_has_hcc(B,CC) <= beneficiary_has_cc(B,CC) &
+    #                              ~( has_cc_that_overrides_this_one(B,CC))
+    return set(c for c in ccs if not (self.overridden_by.get(c,frozenset()) & ccs))
+
+  def demographic_indicators(self,sex,age,orec,medicaid):
+    inds = set()
+    medicaid = medicaid == True
+    oasi = orec == EntitlementReason.OASI
+    disabled = age < 65 and not oasi
+    orig_disabled = orec == EntitlementReason.DIB and not disabled
+
+    for F, MF in (("F","female"),("M","male")):
+      for suffix, L, U in AGE_RANGES:
+        if sex_age_range(MF,sex,age,L,U):
+          inds.add(F + suffix)
+      for suffix, L, U in AGE_RANGES[:4] + [("60_64",60,63)] + AGE_RANGES[6:]:
+        if sex_age_range(MF,sex,age,L,U):
+          inds.add("NE" + F + suffix)
+      if sex_age(MF,sex,age,64) and not oasi:
+        inds.add("NE" + F + "60_64")
+      if (sex_age(MF,sex,age,64) and oasi) or sex_age(MF,sex,age,65):
+        inds.add("NE" + F + "65")
+      for A in range(66,70):
+        if sex_age(MF,sex,age,A):
+          inds.add("NE" + F + str(A))
+
+      if medicaid:
+        MCAID = "MCAID_" + MF.upper()
+        if sex_age_range(MF,sex,age,0,64):
+          inds.add(MCAID + "0_64")
+        if sex_age(MF,sex,age,65):
+          inds.add(MCAID + "65")
+        for suffix, L, U in (("66_69",66,69),("70_74",70,74),("75_GT",75,-1.0)):
+          if sex_age_range(MF,sex,age,L,U):
+            inds.add(MCAID + suffix)
+
+      if orig_disabled:
+        Origdis = "Origdis_" + MF
+        if "NE" + F + "65" in inds:
+          inds.add(Origdis + "65")
+        if inds & set("NE" + F + str(A) for A in range(66,70)):
+          inds.add(Origdis + "66_69")
+        if "NE" + F + "70_74" in inds:
+          inds.add(Origdis + "70_74")
+        if sex_age_range(MF,sex,age,74,-1.0):
+          inds.add(Origdis + "75_GT")
+
+    if medicaid:
+      inds.add("MCAID")
+      if sex == "female":
+        inds.add("MCAID_Female_Disabled" if disabled else "MCAID_Female_Aged")
+      if sex == "male":
+        inds.add("MCAID_Male_Disabled" if disabled else "MCAID_Male_Aged")
+    if orig_disabled:
+      inds.add("ORIGDS")
+      if sex == "female":
+        inds.add("OriginallyDisabled_Female")
+      if sex == "male":
+        inds.add("OriginallyDisabled_Male")
+    return inds
+
+  @property
+  def demographics(self):
+    # the DemographicTable, built on first use
+    if self._demographics is None:
+      self._demographics = DemographicTable(self)
+    return self._demographics
+
+  def demographic_cell(self,sex,age,orec,medicaid):
+    # demographic_indicators() as a frozenset, from the table when in range
+    i = self.demographics.index(sex,age,orec,medicaid)
+    if i is None:
+      return frozenset(self.demographic_indicators(sex,age,orec,medicaid))
+    return self.demographics.indicators[i]
+
+  def demographic_scores(self,sex,age,orec,medicaid):
+    # {model: score} of the demographic indicators alone; for the new
+    # enrollee model, whose variables are all demographic, the whole score
+    i = self.demographics.index(sex,age,orec,medicaid)
+    if i is None:
+      return self.scores(self.demographic_indicators(sex,age,orec,medicaid))
+    return dict(self.demographics.scores[i])
+
+  def hcc_indicators(self,hccs,disabled):
+    inds = set("HCC" + c for c in hccs if c in self.hccees)
+    if disabled:
+      inds.update("DISABLED_HCC" + c for c in self.disabled_hccs if c in hccs)
+      # DISABLED_PRESSURE_ULCER is written against dc(CC,'pressure_ulcer'),
+      # which has its arguments reversed and so never holds
+    for name, first, second in self.interactions:
+      if (first & hccs) and (second & hccs):
+        inds.add(name)
+    return inds
+
+  def indicators(self,sex,age,orec,medicaid,diagnoses):
+    return self.mask_indicators(sex,age,orec,medicaid,
+                                self.cc_mask(sex,age,diagnoses))
+
+  def mask_indicators(self,sex,age,orec,medicaid,ccs):
+    # indicators from a beneficiary_has_cc mask
+    if hcc_metrics.current is not None:
+      return self._profiled_mask_indicators(sex,age,orec,medicaid,ccs,
+                                            hcc_metrics.current)
+    hccs = self.bits.hcc_mask(ccs)
+    disabled = age < 65 and orec != EntitlementReason.OASI
+    return (set(self.demographic_cell(sex,age,orec,medicaid)) |
+            self.bits.indicators(hccs,disabled))
+
+  def _profiled_mask_indicators(self,sex,age,orec,medicaid,ccs,metrics):
+    clock = time.perf_counter
+    t = clock()
+    inds = set(self.demographic_cell(sex,age,orec,medicaid))
+    t, elapsed = clock(), clock() - t
+    metrics.record("demographics",elapsed)
+    hccs = self.bits.hcc_mask(ccs)
+    t, elapsed = clock(), clock() - t
+    metrics.record("hierarchy",elapsed)
+    inds |= self.bits.indicators(hccs,age < 65 and orec != EntitlementReason.OASI)
+    metrics.record("hcc_indicators",clock() - t)
+    metrics.member()
+    return inds
+
+  def scores(self,indicators):
+    # (x_score[B] == sum_(Coef,key=CC)) <= indicator(B,CC) & CC.in_(xvars) &
+    #                                      coefficient(prefix+CC,Coef)
+    # a member with no matching indicator has no score at all
+    metrics = hcc_metrics.current
+    scores = {}
+    for model, (prefix, reg_vars) in self.regressions.items():
+      t = time.perf_counter() if metrics is not None else 0.0
+      coefs = []
+      for ind in sorted(indicators):
+        if ind in reg_vars:
+          coefs.extend(self.coefficients.get(prefix + ind,()))
+      if coefs:
+        scores[model] = sum(coefs)
+      if metrics is not None:
+        metrics.record("sum",time.perf_counter() - t,model)
+    return scores
+
+  def weights(self,indicator):
+    # {model: coefficient} of one indicator in each model it belongs to
+    weights = {}
+    for model, (prefix, reg_vars) in self.regressions.items():
+      if indicator in reg_vars:
+        coefs = self.coefficients.get(prefix + indicator,())
+        if coefs:
+          weights[model] = sum(coefs)
+    return weights
+
+  def output(self,sex,age,orec,medicaid,diagnoses):
+    return self.indicator_output(self.indicators(sex,age,orec,medicaid,diagnoses),
+                                 sex,age)
+
+  def indicator_output(self,inds,sex,age):
+    rows = list(self.scores(inds).items())
+    rows.extend((col,0) for col in self.allvars if col not in inds)
+    rows.extend((col,1) for col in sorted(inds))
+    rows.append(("sex",sex))
+    rows.append(("age",age))
+    return rows
+
+  def sparse_output(self,sex,age,orec,medicaid,diagnoses):
+    # output() without the (col, 0) rows: the scores and the fired indicators
+    inds = self.indicators(sex,age,orec,medicaid,diagnoses)
+    return list(self.scores(inds).items()) + [(col,1) for col in sorted(inds)]
+
+  def member_indicators(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return self.indicators(sex,age,orec,medicaid,diagnoses)
+
+  def member_output(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return self.output(sex,age,orec,medicaid,diagnoses)
+
+  def member_sparse_output(self,member):
+    _, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    return self.sparse_output(sex,age,orec,medicaid,diagnoses)
+
+  def member_cc_mask(self,member):
+    _, sex, age, _, _, diagnoses = member_fields(member)
+    return self.cc_mask(sex,age,diagnoses)
+
+def dob_date(dob):
+  # a date from the dobs hcc_batch.ages_as_of takes: YYYYMMDD strings or
+  # integers, or numpy datetime64 values (or a date), without strptime
+  kind = getattr(getattr(dob,"dtype",None),"kind",None)
+  if kind == "M":
+    dob = dob.astype("M8[D]").item()
+    if dob is None:
+      raise ValueError("dates of birth must be YYYYMMDD")
+    return dob
+  if isinstance(dob,int) or kind in ("i","u"):
+    dob = "%08d" % int(dob)
+  if isinstance(dob,str):
+    dob = dob.strip()
+    if len(dob) != 8 or not dob.isdigit():
+      raise ValueError("dates of birth must be YYYYMMDD")
+    return datetime(int(dob[:4]),int(dob[4:6]),int(dob[6:8]))
+  return dob
+
+def member_fields(member,as_of=None):
+  # (hicno, sex, age, orec, medicaid, diagnoses) of a Beneficiary, or of a
+  # dict holding the Beneficiary fields (age, or dob as YYYYMMDD, whose age
+  # is taken on as_of; see hcc.as_of_date) and a 'diagnoses' list of
+  # (icdcode, codetype) pairs; a negative age (a dob after as_of) is an error
+  if isinstance(member,Beneficiary):
+    if member.age < 0:
+      raise ValueError("member %s has a negative age: %d" % (member.hicno,member.age))
+    return (member.hicno, member.sex, member.age,
+            member.original_reason_entitlement, member.medicaid,
+            [(d.icdcode,d.codetype) for d in member.diagnoses])
+  age = member.get("age")
+  if age is None:
+    age = age_as_of(dob_date(member["dob"]),as_of_date(as_of))
+  if age < 0:
+    raise ValueError("member %s has a negative age: %d" % (member.get("hicno"),age))
+  return (member["hicno"], member["sex"], age,
+          member.get("original_reason_entitlement",EntitlementReason.OASI),
+          member.get("medicaid",False), member.get("diagnoses",()))
+
+ICD_FILES = [("icd10.txt",0),("icd9.txt",9)]
+COEFFICIENT_FILE = "coefficients.txt"
+
+def read_cc_map(icd_files=ICD_FILES):
+  cc_map = defaultdict(list)
+  for f, icdcodetype in icd_files:
+    for icdE, ccE in read_cc_facts(f):
+      if ccE not in cc_map[(icdE,icdcodetype)]:
+        cc_map[(icdE,icdcodetype)].append(ccE)
+  return dict((k,tuple(v)) for k, v in cc_map.items())
+
+def read_coefficient_map(f=COEFFICIENT_FILE):
+  coefficients = defaultdict(list)
+  for label, coeff in read_coefficients(f):
+    coefficients[label].append(coeff)
+  return dict(coefficients)
+
+class ModelSpec:
+  # The reference data of one model version.  File names are relative to
+  # the directory of hcc.py unless absolute, and every table left out is
+  # the one hcc.py defines.
+  def __init__(self,icd_files=ICD_FILES,coefficient_file=COEFFICIENT_FILE,
+               hierarchy=None,categories=None,edits=None,excisions=None,
+               hccees=None,regressions=None,interaction_terms=None,
+               disabled_hccs=None):
+    self.icd_files = [(f,int(icdcodetype)) for f, icdcodetype in icd_files]
+    self.coefficient_file = coefficient_file
+    self.hierarchy = hierarchy if hierarchy is not None else hcc_hierarchy()
+    self.categories = categories if categories is not None else diagnostic_categories()
+    self.edits = edits if edits is not None else cc_edits()
+    self.excisions = excisions if excisions is not None else cc_excisions()
+    self.hccees = hccees if hccees is not None else hcc_codes()
+    # model -> (coefficient prefix, variables)
+    self.regressions = regressions if regressions is not None else {
+                         "community":("CE_",community_regression()),
+                         "institutional":("INS_",institutional_regression()),
+                         "new_enrollee":("NE_",new_enrollee_regression())}
+    self.interaction_terms = (interaction_terms if interaction_terms is not None
+                              else INTERACTION_TERMS)
+    self.disabled_hccs = disabled_hccs if disabled_hccs is not None else DISABLED_HCCS
+
+  def default_sources(self):
+    return (self.icd_files == ICD_FILES and
+            self.coefficient_file == COEFFICIENT_FILE)
+
+# Tables read from files are shared by every version whose files have the
+# same content, and equal variable lists are shared as one frozenset.  They
+# are never modified once built, so any number of threads may read them.
+_shared_tables = {}
+_shared_lock = threading.RLock()
+
+def file_digest(files):
+  digest = hashlib.sha256()
+  for f in files:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),f),"rb") as file:
+      digest.update(file.read())
+  return digest.hexdigest()
+
+def shared_table(kind,files,read):
+  key = (kind,file_digest(files))
+  with _shared_lock:
+    if key not in _shared_tables:
+      _shared_tables[key] = read()
+    return _shared_tables[key]
+
+def shared_frozenset(values):
+  values = frozenset(values)
+  with _shared_lock:
+    return _shared_tables.setdefault(("frozenset",values),values)
+
+def compile_model(spec=None,use_cache=True):
+  # the default ICD maps and coefficients come from the memory-mapped
+  # artifact built by hcc_refcache when it is present and up to date
+  spec = spec or ModelSpec()
+  reference = open_reference() if use_cache and spec.default_sources() else None
+  if reference is not None:
+    cc_map, coefficients = reference.cc_map, reference.coefficients
+  else:
+    cc_map = shared_table("cc",[f for f, _ in spec.icd_files],
+                          lambda: read_cc_map(spec.icd_files))
+    coefficients = shared_table("coefficient",[spec.coefficient_file],
+                                lambda: read_coefficient_map(spec.coefficient_file))
+
+  categories = dict((dcE,shared_frozenset(ccs)) for dcE, ccs in spec.categories)
+  regressions = dict((model,(prefix,shared_frozenset(reg_vars)))
+                     for model, (prefix, reg_vars) in spec.regressions.items())
+  return CompiledModel(cc_map,spec.hierarchy,categories,spec.edits,
+                       spec.excisions,spec.hccees,coefficients,regressions,
+                       spec.interaction_terms,spec.disabled_hccs)
+
+# Registry of model versions, compiled on first use.  The version in this
+# repository was ported from the V21 SAS sources in CMS-sas/.
+DEFAULT_VERSION = "V21"
+_registry = {}
+_compiled = {}
+_registry_lock = threading.RLock()
+
+def register_model(version,spec):
+  with _registry_lock:
+    _registry[version] = spec
+    _compiled.pop(version,None)
+
+def model_versions():
+  return sorted(_registry)
+
+def model_spec(version=None):
+  version = version or DEFAULT_VERSION
+  with _registry_lock:
+    if version not in _registry:
+      raise KeyError("unknown model version: " + str(version))
+    return _registry[version]
+
+def get_model(version=None):
+  version = version or DEFAULT_VERSION
+  model = _compiled.get(version)
+  if model is None:
+    with _registry_lock:
+      if version not in _compiled:
+        if version not in _registry:
+          raise KeyError("unknown model version: " + str(version))
+        _compiled[version] = compile_model(_registry[version])
+      model = _compiled[version]
+  return model
+
+def default_model():
+  return get_model()
+
+def lookup_model(model=None):
+  # a CompiledModel from a version name, a CompiledModel, or None (default)
+  if model is None or isinstance(model,str):
+    return get_model(model)
+  return model
+
+def blended_scores(member,weights):
+  # {model: score} summed across versions, weights as {version: weight}
+  blended = {}
+  for version, weight in weights.items():
+    model = get_model(version)
+    for name, score in model.scores(model.member_indicators(member)).items():
+      blended[name] = blended.get(name,0.0) + weight * score
+  return blended
+
+register_model(DEFAULT_VERSION,ModelSpec())
+
+def _comparable(rows,places):
+  return set((col, round(val,places) if isinstance(val,float) else val)
+             for col, val in rows)
+
+def compare_engines(beneficiaries,places=9):
+  # runs both engines over the same beneficiaries and returns
+  # [(beneficiary, rows only datalog produced, rows only compiled produced)]
+  # for every beneficiary on which they disagree
+  from hcc import output, Col, Val
+  model = default_model()
+  mismatches = []
+  for ben in beneficiaries:
+    datalog = _comparable(output(ben,Col,Val),places)
+    compiled = _comparable(model.member_output(ben),places)
+    if datalog != compiled:
+      mismatches.append((ben, datalog - compiled, compiled - datalog))
+  return mismatches
+
+def compare_bits(members,model=None):
+  # checks the bitset path (cc_mask, HccBits.hcc_mask and indicators)
+  # against the rule-by-rule sets (ccs, hccs, hcc_indicators); returns the
+  # hicnos on which they disagree
+  model = lookup_model(model)
+  bits = model.bits
+  mismatches = []
+  for member in members:
+    hicno, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    disabled = age < 65 and orec != EntitlementReason.OASI
+    ccs = model.ccs(sex,age,diagnoses)
+    hccs = model.hccs(ccs)
+    mask = model.cc_mask(sex,age,diagnoses)
+    hcc_mask = bits.hcc_mask(mask)
+    if (set(bits.ccs(mask)) != ccs or set(bits.ccs(hcc_mask)) != hccs or
+        bits.indicators(hcc_mask,disabled) != model.hcc_indicators(hccs,disabled)):
+      mismatches.append(hicno)
+  return mismatches
+
+if __name__ == "__main__":
+  from hcc_synthetic import synthetic_beneficiaries, synthetic_members
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  mismatches = compare_engines(synthetic_beneficiaries(n))
+  for ben, datalog_only, compiled_only in mismatches:
+    print(ben, "datalog:", sorted(datalog_only), "compiled:", sorted(compiled_only))
+  print("%d of %d beneficiaries differ" % (len(mismatches), n))
+  # the bitset path is cheap to check on many more members
+  bit_mismatches = compare_bits(synthetic_members(100 * n,seed=1))
+  print("%d of %d members differ between the bitset and rule-by-rule paths" %
+        (len(bit_mismatches), 100 * n))
+  sys.exit(1 if mismatches or bit_mismatches else 0)
@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+from itertools import groupby
+import queue
+import sqlite3
+import sys
+import threading
+
+from hcc_stream import flag
+
+# Loading members from a database.  A ConnectionPool hands out DB-API 2.0
+# connections, at most `size` at a time, and keeps them open between uses.
+# Rows are fetched with cursor.fetchmany() a chunk at a time, never row by
+# row or all at once, and load_members() merges two such streams, each on
+# its own cursor of one connection:
+#
+#   members     one row per member, with columns named as the member dict
+#               keys of hcc_compiled.member_fields (hicno, sex, dob or age,
+#               orec or original_reason_entitlement, medicaid)
+#   diagnoses   hicno, icdcode, codetype, any number of rows per member
+#
+# Both queries must be ORDER BY hicno, and the hicnos must sort the same way
+# in python (e.g. integers, or text with the default binary collation);
+# load_members raises a ValueError if they do not, and, as hcc_stream does,
+# for diagnoses of a hicno the member query does not have, unless
+# skip_orphans is set.  Alias columns in the query to match, e.g.
+# SELECT PATIENT_ID AS hicno, SEX AS sex, DOB AS dob.
+
+MEMBERS_QUERY = "SELECT * FROM members ORDER BY hicno"
+DIAGNOSES_QUERY = "SELECT hicno, icdcode, codetype FROM diagnoses ORDER BY hicno"
+
+# column name -> member dict key, and database sex codes -> hcc.py sexes
+MEMBER_COLUMNS = {"orec":"original_reason_entitlement"}
+SEX_CODES = {"M":"male", "F":"female", "1":"male", "2":"female"}
+
+class ConnectionPool:
+  def __init__(self,connect,size=4):
+    # connect() opens one new connection
+    self.connect = connect
+    self.size = size
+    self.idle = queue.LifoQueue()
+    self.slots = threading.BoundedSemaphore(size)
+
+  @contextmanager
+  def connection(self):
+    # with pool.connection() as conn: ...; waits while all size are in use
+    self.slots.acquire()
+    try:
+      try:
+        conn = self.idle.get_nowait()
+      except queue.Empty:
+        conn = self.connect()
+      try:
+        yield conn
+      except BaseException:
+        try:
+          conn.rollback()
+        except Exception:
+          conn.close()
+          conn = None
+        raise
+      finally:
+        if conn is not None:
+          self.idle.put(conn)
+    finally:
+      self.slots.release()
+
+  def close(self):
+    while True:
+      try:
+        self.idle.get_nowait().close()
+      except queue.Empty:
+        return
+
+def connect(constring,size=4):
+  # a pool for a sqlite:///path connection string, as %sql takes them;
+  # other databases take ConnectionPool(lambda: driver.connect(...))
+  if not constring.startswith("sqlite:///"):
+    raise ValueError("only sqlite:/// connection strings are supported: " + constring)
+  path = constring[len("sqlite:///"):]
+  return ConnectionPool(lambda: sqlite3.connect(path,check_same_thread=False),size)
+
+def _fetch(conn,query,params,chunk_size):
+  # yields (column names, rows) per fetchmany() of query, on a new cursor
+  cursor = conn.cursor()
+  try:
+    cursor.arraysize = chunk_size
+    cursor.execute(query,params)
+    columns = [d[0].lower() for d in cursor.description]
+    while True:
+      rows = cursor.fetchmany(chunk_size)
+      if not rows:
+        return
+      yield columns, rows
+  finally:
+    cursor.close()
+
+def fetch_chunks(pool,query,params=(),chunk_size=10000):
+  # yields the rows of query as lists of up to chunk_size rows
+  with pool.connection() as conn:
+    for _, rows in _fetch(conn,query,params,chunk_size):
+      yield rows
+
+def _ordered(rows,query):
+  # rows, checking that their hicnos (first item) never go down
+  previous = None
+  for row in rows:
+    if previous is not None and row[0] < previous:
+      raise ValueError("rows are not ordered by hicno: " + query)
+    previous = row[0]
+    yield row
+
+def _members(conn,query,params,chunk_size):
+  for columns, rows in _fetch(conn,query,params,chunk_size):
+    keys = [MEMBER_COLUMNS.get(c,c) for c in columns]
+    for row in rows:
+      member = dict((k,v) for k, v in zip(keys,row) if v is not None)
+      member["sex"] = SEX_CODES.get(str(member.get("sex","")).upper(),member.get("sex"))
+      if "medicaid" in member:
+        # '0' or 'N' from a text column is False
+        member["medicaid"] = flag(member["medicaid"])
+      yield member["hicno"], member
+
+def _diagnoses(conn,query,params,chunk_size):
+  # yields (hicno, [(icdcode, codetype)]) per member
+  rows = (row for _, rows in _fetch(conn,query,params,chunk_size) for row in rows)
+  for hicno, group in groupby(_ordered(rows,query),key=lambda row: row[0]):
+    yield hicno, [(icd,int(codetype)) for _, icd, codetype in group]
+
+def _orphan(hicno,diagnoses_query,members_query):
+  return ValueError("diagnoses for hicno %r, which the member query does not have: %s / %s" %
+                    (hicno,diagnoses_query,members_query))
+
+def load_members(pool,members_query=MEMBERS_QUERY,diagnoses_query=DIAGNOSES_QUERY,
+                 chunk_size=10000,members_params=(),diagnoses_params=(),
+                 skip_orphans=False):
+  # yields lists of up to chunk_size member dicts, diagnoses attached;
+  # diagnoses of hicnos not in the member query raise a ValueError, or are
+  # skipped with skip_orphans.  Both queries run on one pool connection, so
+  # a pool of size 1 is enough.
+  with pool.connection() as conn:
+    members = _ordered(_members(conn,members_query,members_params,chunk_size),
+                       members_query)
+    diagnoses = _diagnoses(conn,diagnoses_query,diagnoses_params,chunk_size)
+    pending = next(diagnoses,None)
+    chunk = []
+    for hicno, member in members:
+      while pending is not None and pending[0] < hicno:
+        if not skip_orphans:
+          raise _orphan(pending[0],diagnoses_query,members_query)
+        pending = next(diagnoses,None)
+      if pending is not None and pending[0] == hicno:
+        member["diagnoses"] = pending[1]
+        pending = next(diagnoses,None)
+      else:
+        member["diagnoses"] = []
+      chunk.append(member)
+      if len(chunk) == chunk_size:
+        yield chunk
+        chunk = []
+    if pending is not None and not skip_orphans:
+      raise _orphan(pending[0],diagnoses_query,members_query)
+    if chunk:
+      yield chunk
+
+def score_chunks(pool,members_query=MEMBERS_QUERY,diagnoses_query=DIAGNOSES_QUERY,
+                 model=None,as_of=None,chunk_size=10000,skip_orphans=False):
+  # hcc_batch.score_batch of every chunk load_members yields; members given
+  # by dob are aged on as_of
+  from hcc_batch import score_batch
+  for chunk in load_members(pool,members_query,diagnoses_query,chunk_size,
+                            skip_orphans=skip_orphans):
+    yield score_batch(chunk,model,as_of)
+
+if __name__ == "__main__":
+  # python hcc_db.py claims.db [chunk size]: scores the members and
+  # diagnoses tables of a SQLite database
+  import time
+  pool = connect("sqlite:///" + sys.argv[1])
+  chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+  start = time.perf_counter()
+  n = sum(len(scores["hicno"]) for scores in score_chunks(pool,chunk_size=chunk_size))
+  elapsed = time.perf_counter() - start
+  print("%d members in %.2fs (%.0f/s)" % (n,elapsed,n / elapsed if elapsed else 0.0))
+  pool.close()
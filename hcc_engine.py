@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+
+from pyDatalog import Logic
+
+from hcc import ScoringSession, load
+from hcc_cache import ScoreCache
+from hcc_compiled import compile_model, get_model
+
+# Scoring engines as objects.  An HccEngine owns one model configuration and
+# may be called from any number of threads at once:
+#
+#   compiled  a CompiledModel, from the registry (version) or its own
+#             ModelSpec (spec).  The tables are read-only once compiled and
+#             shared with every other engine whose reference files match.
+#   datalog   the rules of hcc.py in a pyDatalog logic of the engine's own.
+#             pyDatalog keeps every Beneficiary and Diagnosis in one
+#             process-wide store, so datalog calls take turns and retract
+#             their members before returning.
+
+_datalog_lock = threading.RLock()
+
+class HccEngine:
+  def __init__(self,version=None,spec=None,engine="compiled",cache_size=0):
+    self.engine = engine
+    if engine == "compiled":
+      self.model = compile_model(spec) if spec is not None else get_model(version)
+      self.cache = ScoreCache(self.model,cache_size) if cache_size else None
+    elif engine == "datalog":
+      if version is not None or spec is not None:
+        raise ValueError("the datalog rules only implement the default model")
+      self.model = None
+      self.cache = None
+      with _datalog_lock:
+        previous = getattr(Logic.tl,"logic",None)
+        Logic()
+        load()
+        self.logic = Logic.tl.logic
+        if previous is not None:
+          Logic.tl.logic = previous
+    else:
+      raise ValueError("unknown engine: " + str(engine))
+
+  def _datalog_output(self,member):
+    # the member may be a Beneficiary, or a dict with a dob (see
+    # hcc.ScoringSession.beneficiary)
+    with _datalog_lock:
+      previous = getattr(Logic.tl,"logic",None)
+      Logic(self.logic)
+      try:
+        with ScoringSession() as session:
+          return session.output(member)
+      finally:
+        if previous is not None:
+          Logic.tl.logic = previous
+
+  def output(self,member):
+    # output(B,Col,Val) rows of a Beneficiary or member dict
+    if self.engine == "datalog":
+      return self._datalog_output(member)
+    return (self.cache or self.model).member_output(member)
+
+  def indicators(self,member):
+    if self.engine == "datalog":
+      return set(col for col, val in self.output(member)
+                 if val == 1 and col not in ("sex","age"))
+    return (self.cache or self.model).member_indicators(member)
+
+  def scores(self,member):
+    if self.engine == "datalog":
+      rows = dict(self.output(member))
+      return dict((name,rows[name]) for name in ("community","institutional","new_enrollee")
+                  if name in rows)
+    if self.cache is not None:
+      return self.cache.member_scores(member)
+    return self.model.scores(self.model.member_indicators(member))
+
+  def score_batch(self,members,as_of=None):
+    # hcc_batch.score_batch with this engine's model (compiled only)
+    from hcc_batch import score_batch
+    if self.engine != "compiled":
+      raise ValueError("batch scoring needs the compiled engine")
+    return score_batch(members,self.cache or self.model,as_of)
+
+def stress(engines,members,threads=8,repeat=4):
+  # scores every member with every engine from a thread pool, `repeat` times
+  # over in shuffled order, and returns the (engine, hicno) pairs whose rows
+  # differ from a single-threaded run
+  import random
+  expected = dict(((i,m["hicno"]),sorted(map(str,e.output(m))))
+                  for i, e in enumerate(engines) for m in members)
+  jobs = [(i,m) for i in range(len(engines)) for m in members] * repeat
+  random.Random(0).shuffle(jobs)
+  def check(job):
+    i, member = job
+    rows = sorted(map(str,engines[i].output(member)))
+    return None if rows == expected[(i,member["hicno"])] else (i,member["hicno"])
+  with ThreadPoolExecutor(threads) as pool:
+    return [bad for bad in pool.map(check,jobs) if bad is not None]
+
+if __name__ == "__main__":
+  from hcc_compiled import ModelSpec
+  from hcc_synthetic import synthetic_members
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+  members = list(synthetic_members(n))
+  engines = [HccEngine(),
+             HccEngine(cache_size=1000),
+             # a second configuration in the same process: no hierarchy
+             HccEngine(spec=ModelSpec(hierarchy=[])),
+             HccEngine(engine="datalog")]
+  compiled = stress(engines[:3],members)
+  datalog = stress(engines[3:],members[:max(1,n // 50)],threads=4,repeat=2)
+  print("%d compiled and %d datalog mismatches" % (len(compiled),len(datalog)))
+  sys.exit(1 if compiled or datalog else 0)
@@ -0,0 +1,188 @@
+from collections import Counter
+import random
+import sys
+
+from hcc import EntitlementReason
+from hcc_compiled import lookup_model, member_fields
+
+# Incremental re-scoring.  Each member keeps its distinct codes, CC set,
+# post-hierarchy HCC set, active indicators and running model scores.  A
+# diagnosis delta only revisits the CCs it changes, the CCs those override
+# (their hierarchy chains), and the indicators and interaction terms that
+# depend on an HCC whose status changed.
+
+class MemberState:
+  def __init__(self,model,hicno,sex,age,orec,medicaid):
+    self.model = model
+    self.hicno = hicno
+    self.sex = sex
+    self.age = age
+    self.disabled = age < 65 and orec != EntitlementReason.OASI
+    # (icd, codetype) -> number of times it was added
+    self.codes = Counter()
+    # CC -> number of distinct codes giving it
+    self.cc_counts = Counter()
+    self.hccs = set()
+    self.indicators = set()
+    self.totals = dict((name,0.0) for name in model.regressions)
+    self.contributors = Counter()
+    for ind in model.demographic_indicators(sex,age,orec,medicaid):
+      self._toggle(ind,True)
+
+  def scores(self):
+    # same as CompiledModel.scores(self.indicators)
+    return dict((name,total) for name, total in self.totals.items()
+                if self.contributors[name])
+
+  def _toggle(self,indicator,on):
+    if on == (indicator in self.indicators):
+      return
+    sign = 1 if on else -1
+    if on:
+      self.indicators.add(indicator)
+    else:
+      self.indicators.discard(indicator)
+    for name, weight in self.model.weights(indicator).items():
+      self.totals[name] += sign * weight
+      self.contributors[name] += sign
+      if not self.contributors[name]:
+        # drop any rounding residue once nothing contributes
+        self.totals[name] = 0.0
+
+  def _is_hcc(self,c):
+    return (c in self.cc_counts and
+            not (self.model.overridden_by.get(c,frozenset()) & self.cc_counts.keys()))
+
+  def apply(self,added=(),removed=()):
+    # returns (scores, {model: change in score})
+    model = self.model
+    before = self.scores()
+    changed_ccs = set()
+    for icd, codetype in added:
+      code = (icd,int(codetype))
+      self.codes[code] += 1
+      if self.codes[code] == 1:
+        for c in model.code_ccs(self.sex,self.age,*code):
+          self.cc_counts[c] += 1
+          if self.cc_counts[c] == 1:
+            changed_ccs.add(c)
+    for icd, codetype in removed:
+      code = (icd,int(codetype))
+      if not self.codes.get(code):
+        continue
+      self.codes[code] -= 1
+      if not self.codes[code]:
+        del self.codes[code]
+        for c in model.code_ccs(self.sex,self.age,*code):
+          self.cc_counts[c] -= 1
+          if not self.cc_counts[c]:
+            del self.cc_counts[c]
+            changed_ccs.add(c)
+
+    # a CC can only gain or lose HCC status if it, or one that overrides
+    # it, came or went
+    affected = set(changed_ccs)
+    for c in changed_ccs:
+      affected |= model.overrides.get(c,frozenset())
+    changed_hccs = set()
+    for c in affected:
+      if self._is_hcc(c) != (c in self.hccs):
+        self.hccs.symmetric_difference_update([c])
+        changed_hccs.add(c)
+
+    terms = {}
+    for c in changed_hccs:
+      if c in model.hccees:
+        self._toggle("HCC" + c,c in self.hccs)
+      if self.disabled and c in model.disabled_hccs:
+        self._toggle("DISABLED_HCC" + c,c in self.hccs)
+      for term in model.interactions_of.get(c,()):
+        terms[term[0]] = term
+    for name, first, second in terms.values():
+      self._toggle(name,bool(first & self.hccs) and bool(second & self.hccs))
+
+    after = self.scores()
+    delta = dict((name,after.get(name,0.0) - before.get(name,0.0))
+                 for name in set(before) | set(after))
+    return after, delta
+
+class IncrementalScorer:
+  def __init__(self,model=None):
+    self.model = lookup_model(model)
+    self.members = {}
+
+  def add_member(self,member):
+    # starts tracking a Beneficiary or member dict; returns its scores
+    hicno, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    state = MemberState(self.model,hicno,sex,age,orec,medicaid)
+    self.members[hicno] = state
+    return state.apply(added=diagnoses)[0]
+
+  def update(self,hicno,added=(),removed=()):
+    # applies a diagnosis delta of (icdcode, codetype) pairs; returns
+    # (scores, {model: change in score})
+    return self.members[hicno].apply(added,removed)
+
+  def scores(self,hicno):
+    return self.members[hicno].scores()
+
+  def indicators(self,hicno):
+    return set(self.members[hicno].indicators)
+
+  def drop_member(self,hicno):
+    self.members.pop(hicno,None)
+
+def _delta_vocabulary(model):
+  # codes whose CCs sit in a hierarchy or an interaction, plus the edited,
+  # excised and unmapped codes, so random deltas exercise those rules
+  from hcc_synthetic import UNMAPPED_CODES, code_vocabulary, edit_vocabulary
+  ruled = set(model.overrides) | set(model.overridden_by)
+  for _, first, second in model.interactions:
+    ruled |= first | second
+  return ([code for code in code_vocabulary() if ruled & set(model.cc_map.get(code,()))] +
+          edit_vocabulary() + UNMAPPED_CODES)
+
+def compare_incremental(members,steps=30,seed=0,tolerance=1e-9):
+  # applies `steps` random add/remove deltas to every member and returns the
+  # (hicno, step) at which the scores, indicators or reported change differ
+  # from scoring the member's current codes from scratch
+  rnd = random.Random(seed)
+  scorer = IncrementalScorer()
+  model = scorer.model
+  vocab = _delta_vocabulary(model)
+  def differ(a,b):
+    return set(a) != set(b) or any(abs(a[k] - b[k]) > tolerance for k in a)
+  bad = []
+  for member in members:
+    hicno, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    codes = Counter((icd,int(codetype)) for icd, codetype in diagnoses)
+    before = scorer.add_member(member)
+    for step in range(steps):
+      added = [rnd.choice(vocab) for _ in range(rnd.randint(0,3))]
+      # removals of codes the member has, and now and then one it has not
+      removed = rnd.sample(sorted(codes),min(len(codes),rnd.randint(0,3)))
+      if rnd.random() < 0.1:
+        removed.append(rnd.choice(vocab))
+      codes.update(added)
+      for code in removed:
+        if codes[code]:
+          codes[code] -= 1
+      codes += Counter()
+      scores, delta = scorer.update(hicno,added,removed)
+      inds = model.indicators(sex,age,orec,medicaid,list(codes))
+      expected = model.scores(inds)
+      change = dict((name,expected.get(name,0.0) - before.get(name,0.0))
+                    for name in set(expected) | set(before))
+      if (differ(scores,expected) or inds != scorer.indicators(hicno) or
+          differ(delta,change)):
+        bad.append((hicno,step))
+      before = expected
+    scorer.drop_member(hicno)
+  return bad
+
+if __name__ == "__main__":
+  from hcc_synthetic import synthetic_members
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+  bad = compare_incremental(synthetic_members(n))
+  print("%d of %d delta steps differ" % (len(bad),30 * n))
+  sys.exit(1 if bad else 0)
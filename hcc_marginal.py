@@ -0,0 +1,170 @@
+import sys
+
+import numpy as np
+
+from hcc import EntitlementReason, as_of_date
+from hcc_compiled import lookup_model, member_fields
+from hcc_population import Population
+
+# Suspect/gap analysis.  For every member and every HCC of the model, the
+# change in each model's score from adding that HCC's CC to the member's
+# diagnoses.  The change takes in everything the added CC does:
+#
+#   the HCC itself, unless a CC the member has overrides it
+#   the member's HCCs it overrides (HCC17 removes HCC18 and HCC19)
+#   DISABLED_HCC terms, for disabled members
+#   interaction terms it completes or (through suppression) breaks
+#
+# Only these terms depend on the CCs, so the demographic part of the score
+# cancels out.  Members are processed in chunks as (member, candidate, CC)
+# boolean arrays over the fixed bit positions of hcc_bitset, so the matrix of
+# a whole population is a few NumPy products per chunk.
+
+class MarginalValues:
+  def __init__(self,hicnos,candidates,values,present):
+    self.hicnos = hicnos
+    # "HCC" + CC of every column
+    self.candidates = candidates
+    # model -> (members, candidates) score increase
+    self.values = values
+    # (members, candidates): the member already has the CC
+    self.present = present
+
+  def top(self,model="community",k=10):
+    # the k largest (hicno, candidate, value) opportunities of the population
+    values = np.where(self.present,-np.inf,self.values[model]).ravel()
+    k = min(k,int((values > 0).sum()))
+    best = np.argpartition(-values,k - 1)[:k] if k else np.zeros(0,dtype=np.int64)
+    best = best[np.argsort(-values[best],kind="stable")]
+    n = len(self.candidates)
+    return [(self.hicnos[i // n],self.candidates[i % n],float(values[i])) for i in best]
+
+  def member_top(self,i,model="community",k=5):
+    # the k largest (candidate, value) opportunities of member i
+    values = np.where(self.present[i],-np.inf,self.values[model][i])
+    best = [j for j in np.argsort(-values,kind="stable")[:k] if values[j] > 0]
+    return [(self.candidates[j],float(values[j])) for j in best]
+
+def _cc_rows(masks,bits):
+  # (n, positions) boolean array of int CC masks
+  packed = bits.pack(masks).astype("<u8")
+  return np.unpackbits(packed.view(np.uint8),axis=1,
+                       bitorder="little")[:,:len(bits.order)].astype(bool)
+
+class _Tables:
+  # the bitset rules of one model as dense arrays
+  def __init__(self,model):
+    bits = model.bits
+    n = len(bits.order)
+    self.suppression = np.zeros((n,n),dtype=np.float32)
+    for bit, suppressed in bits.suppression.items():
+      self.suppression[bit.bit_length() - 1] = _cc_rows([suppressed],bits)[0]
+    self.first = np.array([_cc_rows([first],bits)[0] for _, first, _ in bits.interactions],
+                          dtype=np.float32).reshape(-1,n).T
+    self.second = np.array([_cc_rows([second],bits)[0] for _, _, second in bits.interactions],
+                           dtype=np.float32).reshape(-1,n).T
+    self.candidates = np.array([bits.position[c] for c in bits.order if c in model.hccees])
+    self.names = ["HCC" + bits.order[j] for j in self.candidates]
+    # (positions or terms, models) weights of the HCC, DISABLED_HCC and
+    # interaction terms, models in self.models order
+    self.models = list(model.regressions)
+    def weights(indicator):
+      w = model.weights(indicator)
+      return [w.get(name,0.0) for name in self.models]
+    self.hcc = np.array([weights("HCC" + c) if c in model.hccees else [0.0] * len(self.models)
+                         for c in bits.order])
+    self.disabled = np.array([weights("DISABLED_HCC" + c) if c in model.disabled_hccs
+                              else [0.0] * len(self.models) for c in bits.order])
+    self.interaction = np.array([weights(term) for term, _, _ in bits.interactions]
+                                ).reshape(-1,len(self.models))
+
+  def hcc_scores(self,hccs,disabled):
+    # the CC-dependent part of every model's score of (..., positions) HCC
+    # rows, as (..., models)
+    h = hccs.astype(np.float64)
+    scores = h @ self.hcc
+    scores += (h @ self.disabled) * disabled.reshape((-1,) + (1,) * (hccs.ndim - 1))
+    fired = ((h @ self.first) > 0) & ((h @ self.second) > 0)
+    return scores + fired.astype(np.float64) @ self.interaction
+
+  def chunk(self,ccs,disabled):
+    # {model: (members, candidates)} values of one chunk of CC rows
+    cand = self.candidates
+    suppressed = (ccs.astype(np.float32) @ self.suppression) > 0
+    hccs = ccs & ~suppressed
+    # with candidate k added: its overridees go, and it stays unless
+    # suppressed itself
+    added = hccs[:,None,:] & (self.suppression[cand] == 0)[None,:,:]
+    k = np.arange(len(cand))
+    added[:,k,cand] |= ~suppressed[:,cand]
+    values = self.hcc_scores(added,disabled) - self.hcc_scores(hccs,disabled)[:,None,:]
+    return dict((name,values[:,:,m]) for m, name in enumerate(self.models))
+
+def _member_chunks(members,model,as_of,chunk_size):
+  # yields (hicnos, CC masks, disabled) per chunk of members
+  if isinstance(members,Population):
+    masks = list(members.cc_masks(model))
+    disabled = ((np.frombuffer(members.age,dtype=np.int16) < 65) &
+                (np.frombuffer(members.orec,dtype=np.int8) != EntitlementReason.OASI))
+    for start in range(0,len(members),chunk_size):
+      yield (members.hicnos[start:start + chunk_size],masks[start:start + chunk_size],
+             disabled[start:start + chunk_size])
+    return
+  hicnos, masks, disabled = [], [], []
+  for member in members:
+    hicno, sex, age, orec, _, diagnoses = member_fields(member,as_of)
+    hicnos.append(hicno)
+    masks.append(model.cc_mask(sex,age,diagnoses))
+    disabled.append(age < 65 and orec != EntitlementReason.OASI)
+    if len(hicnos) == chunk_size:
+      yield hicnos, masks, np.array(disabled)
+      hicnos, masks, disabled = [], [], []
+  if hicnos:
+    yield hicnos, masks, np.array(disabled)
+
+def marginal_values(members,model=None,as_of=None,chunk_size=1024):
+  # MarginalValues of every member (a Population, or Beneficiaries or member
+  # dicts aged on as_of) and every HCC of model
+  model = lookup_model(model)
+  as_of = as_of_date(as_of)
+  tables = _Tables(model)
+  hicnos, present = [], []
+  values = dict((name,[]) for name in model.regressions)
+  for chunk_hicnos, masks, disabled in _member_chunks(members,model,as_of,chunk_size):
+    ccs = _cc_rows(masks,model.bits)
+    hicnos.extend(chunk_hicnos)
+    present.append(ccs[:,tables.candidates])
+    for name, v in tables.chunk(ccs,disabled.astype(bool)).items():
+      values[name].append(v)
+  n = len(tables.candidates)
+  return MarginalValues(np.array(hicnos,dtype=object),tables.names,
+                        dict((name,np.concatenate(v) if v else np.zeros((0,n)))
+                             for name, v in values.items()),
+                        np.concatenate(present) if present else np.zeros((0,n),dtype=bool))
+
+def compare_marginal(members,tolerance=1e-9):
+  # the (hicno, candidate, model) values that differ from re-scoring the
+  # member with each candidate CC added
+  model = lookup_model(None)
+  members = list(members)
+  marginal = marginal_values(members,model)
+  bad = []
+  for i, member in enumerate(members):
+    hicno, sex, age, orec, medicaid, diagnoses = member_fields(member)
+    ccs = model.cc_mask(sex,age,diagnoses)
+    base = model.scores(model.mask_indicators(sex,age,orec,medicaid,ccs))
+    for j, candidate in enumerate(marginal.candidates):
+      added = ccs | model.bits.mask([candidate[3:]])
+      scores = model.scores(model.mask_indicators(sex,age,orec,medicaid,added))
+      for name in model.regressions:
+        expected = scores.get(name,0.0) - base.get(name,0.0)
+        if abs(marginal.values[name][i,j] - expected) > tolerance:
+          bad.append((hicno,candidate,name))
+  return bad
+
+if __name__ == "__main__":
+  from hcc_synthetic import synthetic_members
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  bad = compare_marginal(synthetic_members(n))
+  print("%d differences" % len(bad))
+  sys.exit(1 if bad else 0)
@@ -0,0 +1,122 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import time
+
+# Opt-in instrumentation of the compiled engine.  While a Metrics object is
+# enabled, CompiledModel, ScoreCache and hcc_batch record the wall time and
+# call count of each pipeline stage:
+#
+#   cc_map          ICD -> CC mapping of codes without edits or excisions
+#   edits           codes with an edit or excision (cc edit/excised rules)
+#   demographics    age/sex, Medicaid, originally disabled, new enrollee
+#   hierarchy       suppression of overridden CCs
+#   hcc_indicators  HCC, DISABLED_HCC and interaction indicators
+#   sum             coefficient sums, per model
+#   batch_sum       batch matrix products, per model
+#
+# along with counters for members scored and cache hits/misses.  When nothing
+# is enabled (the default) the engine only tests `current is None`.
+
+current = None
+
+class Metrics:
+  def __init__(self,callback=None,every=10000):
+    # callback(snapshot) is called every `every` members
+    self.callback = callback
+    self.every = every
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      # (stage, model) -> seconds / calls; model is "" for whole-member stages
+      self.seconds = defaultdict(float)
+      self.calls = defaultdict(int)
+      self.counters = defaultdict(int)
+      self.started = time.perf_counter()
+
+  def record(self,stage,seconds,model=""):
+    with self.lock:
+      self.seconds[(stage,model)] += seconds
+      self.calls[(stage,model)] += 1
+
+  def count(self,name,n=1):
+    with self.lock:
+      self.counters[name] += n
+
+  def member(self,n=1):
+    with self.lock:
+      before = self.counters["members"]
+      self.counters["members"] = before + n
+    if self.callback is not None and (before + n) // self.every > before // self.every:
+      self.callback(self.snapshot())
+
+  @contextmanager
+  def stage(self,stage,model=""):
+    t = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(stage,time.perf_counter() - t,model)
+
+  def snapshot(self):
+    with self.lock:
+      elapsed = time.perf_counter() - self.started
+      members = self.counters["members"]
+      lookups = self.counters["cache_hits"] + self.counters["cache_misses"]
+      stages = {}
+      for (stage, model), seconds in sorted(self.seconds.items()):
+        name = stage + ":" + model if model else stage
+        stages[name] = {"seconds":seconds, "calls":self.calls[(stage,model)]}
+      return {"elapsed":elapsed,
+              "members":members,
+              "members_per_second":members / elapsed if elapsed else 0.0,
+              "cache_hit_rate":self.counters["cache_hits"] / lookups if lookups else 0.0,
+              "counters":dict(self.counters),
+              "stages":stages}
+
+  def export_text(self,prefix="hcc"):
+    # Prometheus text exposition format
+    def labels(stage,model):
+      return ('{stage="%s",model="%s"}' % (stage,model) if model
+              else '{stage="%s"}' % stage)
+    with self.lock:
+      stages = sorted(self.seconds)
+      lines = ["# TYPE %s_stage_seconds_total counter" % prefix]
+      lines.extend("%s_stage_seconds_total%s %r" %
+                   (prefix,labels(stage,model),self.seconds[(stage,model)])
+                   for stage, model in stages)
+      lines.append("# TYPE %s_stage_calls_total counter" % prefix)
+      lines.extend("%s_stage_calls_total%s %d" %
+                   (prefix,labels(stage,model),self.calls[(stage,model)])
+                   for stage, model in stages)
+      for name, n in sorted(self.counters.items()):
+        lines.append("# TYPE %s_%s_total counter" % (prefix,name))
+        lines.append("%s_%s_total %d" % (prefix,name,n))
+    snapshot = self.snapshot()
+    lines.append("# TYPE %s_members_per_second gauge" % prefix)
+    lines.append("%s_members_per_second %r" % (prefix,snapshot["members_per_second"]))
+    lines.append("# TYPE %s_cache_hit_rate gauge" % prefix)
+    lines.append("%s_cache_hit_rate %r" % (prefix,snapshot["cache_hit_rate"]))
+    return "\n".join(lines) + "\n"
+
+def enable(metrics=None):
+  # starts recording into metrics (a new Metrics if None) and returns it
+  global current
+  current = metrics if metrics is not None else Metrics()
+  return current
+
+def disable():
+  global current
+  metrics, current = current, None
+  return metrics
+
+@contextmanager
+def profiling(metrics=None):
+  # with profiling() as metrics: ...; metrics.snapshot()
+  previous = current
+  try:
+    yield enable(metrics)
+  finally:
+    enable(previous) if previous is not None else disable()
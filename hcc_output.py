@@ -0,0 +1,99 @@
+import struct
+
+import numpy as np
+
+from hcc import as_of_date
+from hcc_batch import coefficient_vectors, indicator_matrix
+from hcc_compiled import lookup_model
+from hcc_stream import chunked
+
+# Wide result tables.  Each member is one row with the three scores and one
+# fixed int8 column per regression variable (model.allvars), filled from the
+# sparse indicator matrix with array operations, never one python object
+# per cell.  Rows are produced and written a chunk at a time:
+#
+#   write_npy      a NumPy .npy file of a structured array, readable with
+#                  np.load(path, mmap_mode="r")
+#   write_parquet  a Parquet file, one row group per chunk (requires pyarrow)
+#
+# For the scores and fired indicators alone, see
+# CompiledModel.sparse_output.
+
+MODELS = ["community","institutional","new_enrollee"]
+
+def wide_dtype(model=None,hicno_width=16):
+  model = lookup_model(model)
+  return np.dtype([("hicno","U%d" % hicno_width)] +
+                  [(name,np.float64) for name in MODELS] +
+                  [(col,np.int8) for col in model.allvars])
+
+def wide_rows(matrix,vectors,dtype):
+  # structured array of an IndicatorMatrix chunk
+  n, ncols = matrix.shape
+  hicno_width = dtype["hicno"].itemsize // 4
+  if n and max(len(str(h)) for h in matrix.hicnos) > hicno_width:
+    raise ValueError("hicno longer than %d characters" % hicno_width)
+  rows = np.zeros(n,dtype=dtype)
+  rows["hicno"] = matrix.hicnos.astype(str)
+  for name in MODELS:
+    rows[name] = matrix.dot(vectors[name])
+  flags = np.zeros((n,ncols),dtype=np.int8)
+  flags[matrix.rows(),matrix.indices] = 1
+  for j, col in enumerate(matrix.columns):
+    rows[col] = flags[:,j]
+  return rows
+
+def wide_chunks(members,model=None,chunk_size=10000,hicno_width=16,as_of=None):
+  # yields one structured array per chunk of members, aged on as_of
+  as_of = as_of_date(as_of)
+  model = lookup_model(model)
+  dtype = wide_dtype(model,hicno_width)
+  vectors = coefficient_vectors(model.allvars,model)
+  for chunk in chunked(members,chunk_size):
+    yield wide_rows(indicator_matrix(chunk,model,as_of),vectors,dtype)
+
+def npy_header(dtype,n,size=None):
+  # a version 1.0 .npy header for n rows, padded with spaces to size bytes
+  # so it can be rewritten in place once the row count is known
+  d = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype),n)
+  if size is None:
+    size = (len(d) + 10 + 1 + 20 + 63) // 64 * 64
+  d = d.ljust(size - 10 - 1) + "\n"
+  if len(d) + 10 != size or len(d) > 65535:
+    raise ValueError("npy header does not fit in %d bytes" % size)
+  return b"\x93NUMPY\x01\x00" + struct.pack("<H",len(d)) + d.encode("latin-1")
+
+def write_npy(members,path,model=None,chunk_size=10000,hicno_width=16,as_of=None):
+  # writes every member's wide row to path; returns the number of rows
+  dtype = wide_dtype(model,hicno_width)
+  header = npy_header(dtype,0)
+  n = 0
+  with open(path,"wb") as f:
+    f.write(header)
+    for rows in wide_chunks(members,model,chunk_size,hicno_width,as_of):
+      f.write(rows.tobytes())
+      n += len(rows)
+    f.seek(0)
+    f.write(npy_header(dtype,n,len(header)))
+  return n
+
+def write_parquet(members,path,model=None,chunk_size=10000,hicno_width=16,as_of=None):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  writer = None
+  n = 0
+  try:
+    for rows in wide_chunks(members,model,chunk_size,hicno_width,as_of):
+      table = pa.table(dict((name,rows[name]) for name in rows.dtype.names))
+      if writer is None:
+        writer = pq.ParquetWriter(path,table.schema)
+      writer.write_table(table)
+      n += len(rows)
+    if writer is None:
+      rows = np.zeros(0,dtype=wide_dtype(model,hicno_width))
+      pq.write_table(pa.table(dict((name,rows[name]) for name in rows.dtype.names)),path)
+  finally:
+    if writer is not None:
+      writer.close()
+  return n
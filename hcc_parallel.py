@@ -0,0 +1,189 @@
+import csv
+import io
+import os
+from multiprocessing import Pool
+import numpy as np
+
+from hcc import Beneficiary, as_of_date
+from hcc_compiled import get_model, member_fields
+from hcc_batch import score_batch
+from hcc_population import Population
+from hcc_stream import chunked, merge_members
+
+# Population scoring across a process pool.  Each worker compiles the
+# reference tables (ICD maps, hierarchy, interactions, coefficients) once in
+# its initializer and scores every chunk it receives with hcc_batch.  The
+# parent only cuts the input into chunks; aging, field extraction and
+# parsing all happen in the workers:
+#
+#   iterables   chunks of the members as given (member dicts; Beneficiary
+#               objects, which do not pickle, as portable_member dicts)
+#   Population  handed to each worker once, then (start, stop) row ranges
+#   CSV files   (imap_file_scores) byte ranges of the member and diagnosis
+#               files; member lines are only counted, and the diagnosis
+#               file is bisected for the hicno at each chunk boundary
+#
+# Chunks come back in input order.
+
+_worker_model = None
+_worker_population = None
+
+def _init_worker(version,population=None):
+  global _worker_model, _worker_population
+  _worker_model = get_model(version)
+  _worker_population = population
+
+def _score_chunk(task):
+  chunk, as_of = task
+  return score_batch(chunk,_worker_model,as_of)
+
+def _score_rows(task):
+  start, stop = task
+  return score_batch(_worker_population.rows(start,stop),_worker_model)
+
+def portable_member(member,as_of=None):
+  # a picklable dict for a Beneficiary or member dict
+  hicno, sex, age, orec, medicaid, diagnoses = member_fields(member,as_of)
+  return {"hicno":hicno, "sex":sex, "age":age,
+          "original_reason_entitlement":int(orec), "medicaid":medicaid,
+          "diagnoses":[(icd,int(codetype)) for icd, codetype in diagnoses]}
+
+def _chunks(members,chunk_size,as_of):
+  for chunk in chunked(members,chunk_size):
+    yield ([portable_member(m,as_of) if isinstance(m,Beneficiary) else m for m in chunk],
+           as_of)
+
+def imap_scores(members,processes=None,chunk_size=2000,version=None,as_of=None):
+  # yields the score_batch result of each chunk of members, in input order;
+  # members may be a Population or any iterable, e.g.
+  # hcc_stream.stream_members(...), and version names a registered model
+  # version (hcc_compiled.register_model; workers started with the spawn
+  # method only see versions registered at import time); members given by
+  # dob are aged on as_of
+  as_of = as_of_date(as_of)
+  if isinstance(members,Population):
+    ranges = [(start,start + chunk_size) for start in range(0,len(members),chunk_size)]
+    with Pool(processes,initializer=_init_worker,initargs=(version,members)) as pool:
+      for scores in pool.imap(_score_rows,ranges):
+        yield scores
+    return
+  with Pool(processes,initializer=_init_worker,initargs=(version,)) as pool:
+    for scores in pool.imap(_score_chunk,_chunks(members,chunk_size,as_of)):
+      yield scores
+
+def _header(path):
+  # (field names, offset of the first row) of a CSV file
+  with open(path,"rb") as f:
+    line = f.readline()
+  return next(csv.reader([line.decode("utf-8-sig")])), len(line)
+
+def _hicno(line,index):
+  text = line.decode("utf-8")
+  if '"' in text:
+    return next(csv.reader([text]))[index]
+  return text.rstrip("\r\n").split(",")[index]
+
+def _seek_hicno(f,lo,hi,index,hicno):
+  # the offset of the first row at or after hicno between line starts lo and
+  # hi, by bisection of a file sorted by hicno
+  while lo < hi:
+    mid = (lo + hi) // 2
+    f.seek(mid - 1)
+    f.readline()
+    p = f.tell()
+    if p >= hi:
+      # no line starts in [mid, hi): scan the few from lo
+      f.seek(lo)
+      while lo < hi:
+        line = f.readline()
+        if line.strip() and _hicno(line,index) >= hicno:
+          return lo
+        lo += len(line)
+      return hi
+    line = f.readline()
+    if not line.strip() or _hicno(line,index) < hicno:
+      lo = p + len(line)
+    else:
+      hi = p
+  return lo
+
+def file_ranges(members_path,diagnoses_path,chunk_size):
+  # yields ((start, stop), (start, stop), (low, high)) byte ranges of the
+  # member and diagnosis files holding the hicnos low <= hicno < high (None
+  # for no bound), chunk_size members at a time.  Both files must be sorted
+  # by hicno with one row per line (see hcc_stream); only the member rows at
+  # chunk boundaries are parsed here, and the workers check the rest.
+  member_columns, member_start = _header(members_path)
+  diagnosis_columns, diagnosis_start = _header(diagnoses_path)
+  m_index = member_columns.index("hicno")
+  d_index = diagnosis_columns.index("hicno")
+  d_end = os.path.getsize(diagnoses_path)
+  with open(members_path,"rb") as members, open(diagnoses_path,"rb") as diagnoses:
+    members.seek(member_start)
+    start = pos = member_start
+    d_start, low, n = diagnosis_start, None, 0
+    for line in iter(members.readline,b""):
+      if line.strip():
+        if n == chunk_size:
+          high = _hicno(line,m_index)
+          d_stop = _seek_hicno(diagnoses,d_start,d_end,d_index,high)
+          yield (start,pos), (d_start,d_stop), (low,high)
+          start, d_start, low, n = pos, d_stop, high, 0
+        n += 1
+      pos += len(line)
+    if n:
+      yield (start,pos), (d_start,d_end), (low,None)
+
+def _range_rows(path,fields,start,stop,low,high):
+  # the rows of one byte range, checking each hicno is within [low, high)
+  with open(path,"rb") as f:
+    f.seek(start)
+    text = f.read(stop - start).decode("utf-8")
+  for row in csv.DictReader(io.StringIO(text,newline=""),fieldnames=fields):
+    hicno = str(row["hicno"])
+    if (low is not None and hicno < low) or (high is not None and hicno >= high):
+      raise ValueError("%s is not sorted by hicno: %s between %s and %s" %
+                       (path,hicno,low,high))
+    yield row
+
+def _score_file_range(task):
+  members_path, member_columns, member_range, diagnoses_path, diagnosis_columns, \
+    diagnosis_range, (low, high), as_of = task
+  members = merge_members(_range_rows(members_path,member_columns,*member_range,low,high),
+                          _range_rows(diagnoses_path,diagnosis_columns,*diagnosis_range,
+                                      low,high),
+                          as_of,members_path,diagnoses_path)
+  return score_batch(list(members),_worker_model)
+
+def imap_file_scores(members_path,diagnoses_path,processes=None,chunk_size=2000,
+                     version=None,as_of=None):
+  # imap_scores of hcc_stream.stream_members(members_path, diagnoses_path),
+  # with each worker reading and parsing its own byte range of the two CSV
+  # files
+  as_of = as_of_date(as_of)
+  member_columns, diagnosis_columns = _header(members_path)[0], _header(diagnoses_path)[0]
+  tasks = ((members_path,member_columns,member_range,
+            diagnoses_path,diagnosis_columns,diagnosis_range,bounds,as_of)
+           for member_range, diagnosis_range, bounds
+           in file_ranges(members_path,diagnoses_path,chunk_size))
+  with Pool(processes,initializer=_init_worker,initargs=(version,)) as pool:
+    for scores in pool.imap(_score_file_range,tasks):
+      yield scores
+
+def _concatenate(results,version):
+  if not results:
+    return score_batch([],version)
+  return dict((key,np.concatenate([r[key] for r in results]))
+              for key in results[0])
+
+def score_population(members,processes=None,chunk_size=2000,version=None,as_of=None):
+  # same result as hcc_batch.score_batch(members,version,as_of), computed on
+  # a process pool
+  return _concatenate(list(imap_scores(members,processes,chunk_size,version,as_of)),
+                      version)
+
+def score_files(members_path,diagnoses_path,processes=None,chunk_size=2000,version=None,
+                as_of=None):
+  # same result as score_batch(stream_members(...)), computed on a process pool
+  return _concatenate(list(imap_file_scores(members_path,diagnoses_path,processes,
+                                            chunk_size,version,as_of)),version)
@@ -0,0 +1,170 @@
+from array import array
+import time
+
+from hcc import as_of_date, read_cc_facts
+from hcc_compiled import ICD_FILES, SEXES, lookup_model, member_fields
+import hcc_metrics
+
+# Compact population storage.  Instead of a Beneficiary and one Diagnosis
+# object per claim line, a Population keeps one typed array per field
+# (struct of arrays) and every member's diagnoses as a slice of one shared
+# int32 array of interned code ids:
+#
+#   codes[offsets[i]:offsets[i+1]]   the distinct code ids of member i
+#
+# Code ids come from the icd10.txt/icd9.txt vocabularies in file order;
+# codes outside them are appended as they are seen.  The compiled engine
+# scores a Population directly from the ids (see indicators below).
+
+class CodeTable:
+  def __init__(self,icd_files=ICD_FILES):
+    # id -> (icdcode, codetype), and back
+    self.codes = []
+    self.ids = {}
+    for f, icdcodetype in icd_files:
+      for icdE, _ in read_cc_facts(f):
+        self.intern(icdE,icdcodetype)
+
+  def intern(self,icd,codetype):
+    code = (icd,int(codetype))
+    i = self.ids.get(code)
+    if i is None:
+      i = self.ids[code] = len(self.codes)
+      self.codes.append(code)
+    return i
+
+  def __getitem__(self,i):
+    return self.codes[i]
+
+  def __len__(self):
+    return len(self.codes)
+
+class Population:
+  def __init__(self,members=(),codes=None,as_of=None):
+    # members given by dob are aged on as_of (see hcc.as_of_date), fixed
+    # when the population is created
+    self.as_of = as_of_date(as_of)
+    self.codes = codes if codes is not None else CodeTable()
+    self.hicnos = []
+    # sex is an index into self.sexes
+    self.sexes = []
+    self.sex = array("b")
+    self.age = array("h")
+    self.orec = array("b")
+    self.medicaid = array("b")
+    self.offsets = array("q",[0])
+    self.diagnoses = array("i")
+    self.extend(members)
+
+  def append(self,member):
+    # a Beneficiary or member dict (see hcc_compiled.member_fields)
+    hicno, sex, age, orec, medicaid, diagnoses = member_fields(member,self.as_of)
+    if sex not in self.sexes:
+      self.sexes.append(sex)
+    self.hicnos.append(hicno)
+    self.sex.append(self.sexes.index(sex))
+    self.age.append(age)
+    self.orec.append(int(orec))
+    self.medicaid.append(medicaid == True)
+    self.diagnoses.extend(sorted(set(self.codes.intern(icd,codetype)
+                                     for icd, codetype in diagnoses)))
+    self.offsets.append(len(self.diagnoses))
+
+  def extend(self,members):
+    # ages of a whole chunk of dobs are computed at once (hcc_batch.with_ages)
+    from hcc_batch import with_ages
+    for member in with_ages(members,self.as_of):
+      self.append(member)
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  def code_ids(self,i):
+    return self.diagnoses[self.offsets[i]:self.offsets[i+1]]
+
+  def fields(self,i):
+    # (hicno, sex, age, orec, medicaid, diagnoses) as member_fields gives them
+    return (self.hicnos[i], self.sexes[self.sex[i]], self.age[i], self.orec[i],
+            bool(self.medicaid[i]), [self.codes[c] for c in self.code_ids(i)])
+
+  def rows(self,start,stop):
+    # members start to stop as a Population sharing this one's code table
+    stop = min(stop,len(self))
+    part = Population(codes=self.codes,as_of=self.as_of)
+    part.hicnos = self.hicnos[start:stop]
+    part.sexes = self.sexes
+    part.sex = self.sex[start:stop]
+    part.age = self.age[start:stop]
+    part.orec = self.orec[start:stop]
+    part.medicaid = self.medicaid[start:stop]
+    base = self.offsets[start]
+    part.offsets = array("q",(offset - base for offset in self.offsets[start:stop + 1]))
+    part.diagnoses = self.diagnoses[base:self.offsets[stop]]
+    return part
+
+  def member(self,i):
+    hicno, sex, age, orec, medicaid, diagnoses = self.fields(i)
+    return {"hicno":hicno, "sex":sex, "age":age,
+            "original_reason_entitlement":orec, "medicaid":medicaid,
+            "diagnoses":diagnoses}
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self.member(i)
+
+  def cc_masks(self,model=None):
+    # yields every member's beneficiary_has_cc mask; codes without edits or
+    # excisions are mapped once per id
+    model = lookup_model(model)
+    masks = [None] * len(self.codes)
+    special = set(self.codes.ids[code] for code in
+                  list(model.edits) + list(model.excisions)
+                  if code in self.codes.ids)
+    metrics = hcc_metrics.current
+    clock = time.perf_counter
+    for i in range(len(self)):
+      mask = 0
+      sex, age = self.sexes[self.sex[i]], self.age[i]
+      for c in self.code_ids(i):
+        t = clock() if metrics is not None else 0.0
+        if c in special:
+          mask |= model.bits.mask(model.code_ccs(sex,age,*self.codes[c]))
+          if metrics is not None:
+            metrics.record("edits",clock() - t)
+          continue
+        m = masks[c]
+        if m is None:
+          m = masks[c] = model.bits.mask(model.cc_map.get(self.codes[c],()))
+        mask |= m
+        if metrics is not None:
+          metrics.record("cc_map",clock() - t)
+      yield mask
+
+  def indicators(self,model=None):
+    # yields (hicno, indicators) for every member
+    model = lookup_model(model)
+    for i, ccs in enumerate(self.cc_masks(model)):
+      yield self.hicnos[i], model.mask_indicators(
+        self.sexes[self.sex[i]],self.age[i],self.orec[i],
+        self.medicaid[i] == 1,ccs)
+
+  def demographic_scores(self,model=None):
+    # {model: array} of every member's demographic score (0.0 for none), one
+    # DemographicTable lookup per member; for the new enrollee model this is
+    # the whole score
+    import numpy as np
+    model = lookup_model(model)
+    table = model.demographics
+    sex_ids = np.array([SEXES.index(s) if s in SEXES else -1 for s in self.sexes] + [-1])
+    index = table.index_array(sex_ids[np.frombuffer(self.sex,dtype=np.int8)],
+                              np.frombuffer(self.age,dtype=np.int16),
+                              np.frombuffer(self.orec,dtype=np.int8),
+                              np.frombuffer(self.medicaid,dtype=np.int8))
+    scores = dict((name,np.frombuffer(sums,dtype=np.float64)[index])
+                  for name, sums in table.sums.items())
+    for i in np.flatnonzero(index < 0):
+      cell = model.demographic_scores(self.sexes[self.sex[i]],self.age[i],
+                                      self.orec[i],self.medicaid[i] == 1)
+      for name in scores:
+        scores[name][i] = cell.get(name,0.0)
+    return scores
@@ -0,0 +1,166 @@
+from bisect import bisect_left, bisect_right
+import hashlib
+import mmap
+import os
+import struct
+
+from hcc import read_cc_facts, read_coefficients
+
+# Precompiled binary copy of the ICD -> CC maps and the coefficients, built
+# by `python hcc_refcache.py`.  The file is opened with mmap, so every
+# process on a host shares one page-cached copy instead of parsing the text
+# files into its own dicts.  Each table is a sorted string table: an offset
+# index into a blob of sorted keys, with a parallel array of values.
+#
+# header:  magic, sha256 of the source files, then (count, offsets position,
+#          keys position, values position) for the ICD and coefficient tables
+# ICD key: b"<codetype>|<icd>", value: CC as uint16
+# coefficient key: label, value: float64
+
+MAGIC = b"HCCREF01"
+HEADER = struct.Struct("<8s32s" + "IIII" * 2)
+SOURCES = ["icd10.txt","icd9.txt","coefficients.txt"]
+ICD_FILES = [("icd10.txt",0),("icd9.txt",9)]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATH = os.path.join(HERE,"reference.bin")
+
+def source_digest():
+  digest = hashlib.sha256(MAGIC)
+  for f in SOURCES:
+    with open(os.path.join(HERE,f),"rb") as file:
+      digest.update(file.read())
+  return digest.digest()
+
+def icd_key(icd,codetype):
+  return ("%d|%s" % (int(codetype),icd)).encode()
+
+def _icd(key):
+  codetype, _, icd = key.decode().partition("|")
+  return icd, int(codetype)
+
+def _table(entries,value_format):
+  # (index, keys, values) byte strings for sorted (key, value) entries
+  index, keys = [0], []
+  for key, _ in entries:
+    keys.append(key)
+    index.append(index[-1] + len(key))
+  return (struct.pack("<%dI" % len(index),*index), b"".join(keys),
+          struct.pack("<%d%s" % (len(entries),value_format),
+                      *[value for _, value in entries]))
+
+def build(path=DEFAULT_PATH):
+  icd_entries = sorted(set((icd_key(icdE,icdcodetype),int(ccE))
+                           for f, icdcodetype in ICD_FILES
+                           for icdE, ccE in read_cc_facts(f)))
+  coef_entries = sorted((label.encode(),coeff)
+                        for label, coeff in read_coefficients("coefficients.txt"))
+  sections, fields, position = [], [], HEADER.size
+  for entries, value_format in ((icd_entries,"H"),(coef_entries,"d")):
+    index, blob, values = _table(entries,value_format)
+    fields.extend([len(entries), position, position + len(index),
+                   position + len(index) + len(blob)])
+    sections.extend([index,blob,values])
+    position += len(index) + len(blob) + len(values)
+  tmp = path + ".tmp"
+  with open(tmp,"wb") as file:
+    file.write(HEADER.pack(MAGIC,source_digest(),*fields))
+    for section in sections:
+      file.write(section)
+  os.replace(tmp,path)
+  return path
+
+class SortedStringTable:
+  def __init__(self,buf,count,index_pos,keys_pos,values_pos,value_format):
+    self.buf = buf
+    self.count = count
+    self.index_pos = index_pos
+    self.keys_pos = keys_pos
+    self.values_pos = values_pos
+    self.value = struct.Struct("<" + value_format)
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self,i):
+    # the i-th key, so that bisect can search the table in place
+    start, end = struct.unpack_from("<II",self.buf,self.index_pos + 4 * i)
+    return self.buf[self.keys_pos + start:self.keys_pos + end]
+
+  def items(self):
+    # every (key, value) in key order
+    size = self.value.size
+    for i in range(self.count):
+      yield bytes(self[i]), self.value.unpack_from(self.buf,self.values_pos + size * i)[0]
+
+  def values(self,key):
+    lo = bisect_left(self,key)
+    hi = bisect_right(self,key,lo)
+    size = self.value.size
+    return tuple(self.value.unpack_from(self.buf,self.values_pos + size * i)[0]
+                 for i in range(lo,hi))
+
+# Lookups are remembered per process, so a worker only ever holds the codes
+# it has actually seen.
+
+class IcdTable:
+  # the cc_map interface of CompiledModel: (icd, codetype) -> tuple of CCs
+  def __init__(self,table):
+    self.table = table
+    self.memo = {}
+
+  def get(self,key,default=()):
+    ccs = self.memo.get(key)
+    if ccs is None:
+      ccs = self.memo[key] = tuple(str(c) for c in self.table.values(icd_key(*key)))
+    return ccs or default
+
+  def items(self):
+    # every ((icd, codetype), CCs), as read_cc_map gives them
+    key, ccs = None, []
+    for k, cc in self.table.items():
+      if k != key and ccs:
+        yield _icd(key), tuple(ccs)
+        ccs = []
+      key = k
+      ccs.append(str(cc))
+    if ccs:
+      yield _icd(key), tuple(ccs)
+
+class CoefficientTable:
+  # the coefficients interface of CompiledModel: label -> list of values
+  def __init__(self,table):
+    self.table = table
+    self.memo = {}
+
+  def get(self,label,default=()):
+    coefs = self.memo.get(label)
+    if coefs is None:
+      coefs = self.memo[label] = list(self.table.values(label.encode()))
+    return coefs or default
+
+class MappedReference:
+  def __init__(self,path):
+    with open(path,"rb") as file:
+      self.buf = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+    fields = HEADER.unpack_from(self.buf,0)
+    self.magic, self.digest = fields[:2]
+    self.cc_map = IcdTable(SortedStringTable(self.buf,*fields[2:6],value_format="H"))
+    self.coefficients = CoefficientTable(SortedStringTable(self.buf,*fields[6:10],value_format="d"))
+
+  def fresh(self):
+    return self.magic == MAGIC and self.digest == source_digest()
+
+def open_reference(path=DEFAULT_PATH):
+  # the mapped artifact, or None when it is missing or older than the text
+  # files, in which case callers parse the text files instead
+  if not os.path.exists(path):
+    return None
+  try:
+    reference = MappedReference(path)
+  except (ValueError, struct.error):
+    return None
+  return reference if reference.fresh() else None
+
+if __name__ == "__main__":
+  print(build())
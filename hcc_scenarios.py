@@ -0,0 +1,69 @@
+from collections import Counter
+
+from hcc import as_of_date
+from hcc_compiled import lookup_model, member_fields
+
+# What-if scoring of diagnosis scenarios.  A member's own diagnoses are the
+# base; each scenario adds and/or removes (icdcode, codetype) pairs, e.g. the
+# codes a chart review or home assessment would add, or the year-2 claims on
+# top of year 1.  The base codes are mapped to CCs once, and each scenario
+# only maps the codes it adds, adjusts the CC counts and re-applies the
+# hierarchy, indicator and coefficient steps.
+#
+# Scenarios are given as {name: (added, removed)}; the name 'base' is taken
+# by the member's own result.  Each result holds
+#
+#   scores     {model: score} under the scenario
+#   change     {model: scenario score - base score}
+#   gained     indicators the scenario turns on
+#   lost       indicators the scenario turns off
+
+def _codes(diagnoses):
+  return set((icd,int(codetype)) for icd, codetype in diagnoses)
+
+def member_scenarios(member,scenarios,model=None,as_of=None):
+  # {'base': {'scores', 'indicators'}, name: {'scores', 'change', 'gained',
+  #  'lost', 'indicators'}} for one Beneficiary or member dict
+  if "base" in scenarios:
+    raise ValueError("'base' is the member's own result, not a scenario name")
+  model = lookup_model(model)
+  _, sex, age, orec, medicaid, diagnoses = member_fields(member,as_of)
+  base_codes = _codes(diagnoses)
+  ccs_of = dict((code,model.code_ccs(sex,age,*code)) for code in base_codes)
+  base_counts = Counter(c for ccs in ccs_of.values() for c in ccs)
+  base = model.mask_indicators(sex,age,orec,medicaid,model.bits.mask(base_counts))
+  base_scores = model.scores(base)
+  results = {"base":{"scores":base_scores, "indicators":base}}
+
+  for name, (added, removed) in scenarios.items():
+    codes = (base_codes - _codes(removed)) | _codes(added)
+    counts = Counter(base_counts)
+    for code in base_codes - codes:
+      counts.subtract(ccs_of[code])
+    for code in codes - base_codes:
+      if code not in ccs_of:
+        ccs_of[code] = model.code_ccs(sex,age,*code)
+      counts.update(ccs_of[code])
+    inds = model.mask_indicators(sex,age,orec,medicaid,
+                                 model.bits.mask(c for c, n in counts.items() if n > 0))
+    scores = model.scores(inds)
+    results[name] = {"scores":scores,
+                     "change":dict((m,scores.get(m,0.0) - base_scores.get(m,0.0))
+                                   for m in set(scores) | set(base_scores)),
+                     "gained":inds - base,
+                     "lost":base - inds,
+                     "indicators":inds}
+  return results
+
+def population_scenarios(members,scenarios,model=None,as_of=None):
+  # yields (hicno, scenario name, result) for every member and scenario in
+  # one pass; scenarios is either the same {name: (added, removed)} for
+  # every member or a function of the member returning one
+  model = lookup_model(model)
+  as_of = as_of_date(as_of)
+  for member in members:
+    hicno = member_fields(member,as_of)[0]
+    member_scenario = scenarios(member) if callable(scenarios) else scenarios
+    for name, result in member_scenarios(member,member_scenario,model,as_of).items():
+      if name != "base":
+        yield hicno, name, result
@@ -0,0 +1,322 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from hcc import EntitlementReason, payment_year_as_of
+from hcc_batch import ages_as_of
+from hcc_compiled import member_fields
+from hcc_engine import HccEngine
+from hcc_stream import flag
+
+# Local scoring server.  Callers POST members as JSON to /score and get back
+# their community, institutional and new enrollee scores.  Requests that
+# arrive together are coalesced into micro-batches: a batch is scored as
+# soon as it holds max_batch members, or max_wait seconds after its first
+# member arrived, with one HccEngine.score_batch call on a worker thread.
+#
+#   POST /score   a member, or a list of members, as dicts with the
+#                 Beneficiary fields (dob as YYYYMMDD, or age) and a
+#                 'diagnoses' list of [icdcode, codetype] pairs
+#   GET  /stats   batch and queue depth histograms, for tuning max_batch
+#                 and max_wait
+
+MODELS = ["community","institutional","new_enrollee"]
+
+class Histogram:
+  # counts in power-of-two buckets: 0, 1, 2-3, 4-7, ...
+  def __init__(self):
+    self.counts = {}
+    self.total = 0
+    self.n = 0
+
+  def add(self,value):
+    # values below 1 (e.g. sub-millisecond waits) go in bucket 0
+    n = int(value)
+    bucket = 0 if n <= 0 else 1 << (n.bit_length() - 1)
+    self.counts[bucket] = self.counts.get(bucket,0) + 1
+    self.total += value
+    self.n += 1
+
+  def snapshot(self):
+    return {"count":self.n,
+            "mean":self.total / self.n if self.n else 0.0,
+            "buckets":dict(("%d-%d" % (b,max(b,2 * b - 1)),c)
+                           for b, c in sorted(self.counts.items()))}
+
+class MicroBatcher:
+  def __init__(self,engine,max_batch=256,max_wait=0.005,as_of=None):
+    self.engine = engine
+    # members given by dob are aged on as_of, or on the day they are scored
+    self.as_of = as_of
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self.queue = asyncio.Queue()
+    self.batch_sizes = Histogram()
+    self.queue_depths = Histogram()
+    self.wait_ms = Histogram()
+    self.members = 0
+
+  async def submit(self,member):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((member,future,time.perf_counter()))
+    return await future
+
+  async def next_batch(self):
+    batch = [await self.queue.get()]
+    self.queue_depths.add(self.queue.qsize() + 1)
+    deadline = asyncio.get_running_loop().time() + self.max_wait
+    while len(batch) < self.max_batch:
+      while len(batch) < self.max_batch and not self.queue.empty():
+        batch.append(self.queue.get_nowait())
+      timeout = deadline - asyncio.get_running_loop().time()
+      if len(batch) == self.max_batch or timeout <= 0:
+        break
+      # not wait_for, which can drop an item that arrives as it times out
+      getter = asyncio.ensure_future(self.queue.get())
+      await asyncio.wait([getter],timeout=timeout)
+      if not getter.done():
+        getter.cancel()
+        break
+      batch.append(getter.result())
+    return batch
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = await self.next_batch()
+      # any error fails this batch's requests, not the batcher
+      try:
+        self.batch_sizes.add(len(batch))
+        self.members += len(batch)
+        now = time.perf_counter()
+        for _, _, queued in batch:
+          self.wait_ms.add((now - queued) * 1000)
+        scores = await loop.run_in_executor(None,self.engine.score_batch,
+                                            [member for member, _, _ in batch],
+                                            self.as_of)
+        for i, (_, future, _) in enumerate(batch):
+          if not future.done():
+            result = {"hicno":scores["hicno"][i]}
+            result.update((name,float(scores[name][i])) for name in MODELS)
+            future.set_result(result)
+      except Exception as e:
+        for _, future, _ in batch:
+          if not future.done():
+            future.set_exception(e)
+
+  def stats(self):
+    return {"members":self.members,
+            "queue_depth_now":self.queue.qsize(),
+            "batch_size":self.batch_sizes.snapshot(),
+            "queue_depth":self.queue_depths.snapshot(),
+            "queue_wait_ms":self.wait_ms.snapshot(),
+            "max_batch":self.max_batch,
+            "max_wait":self.max_wait}
+
+def check_member(member,as_of=None):
+  # the member with its fields coerced to the types the engine expects;
+  # fails on a member the engine could not score, before it joins a batch
+  if not isinstance(member,dict):
+    raise ValueError("a member must be a JSON object")
+  member = dict(member)
+  if not isinstance(member["sex"],str):
+    raise ValueError("sex must be a string")
+  if member.get("age") is None:
+    # the dob parser of the batch path (hcc_batch.with_ages)
+    age = int(ages_as_of([member["dob"]],as_of)[0])
+  else:
+    age = member["age"] = int(member["age"])
+  member["original_reason_entitlement"] = EntitlementReason(
+    int(member.get("original_reason_entitlement",EntitlementReason.OASI)))
+  member["medicaid"] = flag(member.get("medicaid",False))
+  diagnoses = member.get("diagnoses",[])
+  if not isinstance(diagnoses,list):
+    raise ValueError("diagnoses must be a list of [icdcode, codetype] pairs")
+  for d in diagnoses:
+    if not isinstance(d,list) or len(d) != 2 or not isinstance(d[0],str):
+      raise ValueError("not an [icdcode, codetype] pair: %s" % json.dumps(d))
+  member["diagnoses"] = [(icd,int(codetype)) for icd, codetype in diagnoses]
+  member_fields(dict(member,age=age))
+  return member
+
+async def read_request(reader):
+  # (method, path, headers, body) of one HTTP/1.1 request, or None at EOF
+  line = await reader.readline()
+  if not line:
+    return None
+  method, path, _ = line.decode("latin-1").split(" ",2)
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b"\r\n",b"\n",b""):
+      break
+    name, _, value = line.decode("latin-1").partition(":")
+    headers[name.strip().lower()] = value.strip()
+  body = await reader.readexactly(int(headers.get("content-length",0)))
+  return method, path, headers, body
+
+def response(status,payload,keep_alive):
+  body = json.dumps(payload).encode()
+  head = ("HTTP/1.1 %s\r\nContent-Type: application/json\r\n"
+          "Content-Length: %d\r\nConnection: %s\r\n\r\n" %
+          (status,len(body),"keep-alive" if keep_alive else "close"))
+  return head.encode("latin-1") + body
+
+async def handle(batcher,reader,writer):
+  try:
+    while True:
+      request = await read_request(reader)
+      if request is None:
+        break
+      method, path, headers, body = request
+      keep_alive = headers.get("connection","").lower() != "close"
+      if method == "GET" and path == "/stats":
+        status, payload = "200 OK", batcher.stats()
+      elif method == "POST" and path == "/score":
+        try:
+          members = json.loads(body or b"null")
+          single = not isinstance(members,list)
+          members = [members] if single else members
+          for i, member in enumerate(members):
+            try:
+              members[i] = check_member(member,batcher.as_of)
+            except KeyError as e:
+              raise ValueError("member %d: no %s" % (i,e))
+            except (ValueError, TypeError, AttributeError) as e:
+              raise ValueError("member %d: %s" % (i,e))
+        except ValueError as e:
+          status, payload = "400 Bad Request", {"error":str(e)}
+        else:
+          try:
+            results = await asyncio.gather(*[batcher.submit(m) for m in members])
+            status, payload = "200 OK", results[0] if single else results
+          except Exception as e:
+            status, payload = "500 Internal Server Error", {"error":str(e)}
+      else:
+        status, payload = "404 Not Found", {"error":"no such endpoint"}
+      writer.write(response(status,payload,keep_alive))
+      await writer.drain()
+      if not keep_alive:
+        break
+  except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+    pass
+  finally:
+    writer.close()
+
+async def start_server(host="127.0.0.1",port=8080,engine=None,max_batch=256,
+                       max_wait=0.005,as_of=None):
+  # (asyncio server, batcher); the batcher task runs until the loop stops
+  batcher = MicroBatcher(engine or HccEngine(),max_batch,max_wait,as_of)
+  batcher.task = asyncio.ensure_future(batcher.run())
+  server = await asyncio.start_server(lambda r, w: handle(batcher,r,w),host,port,
+                                      backlog=1024)
+  return server, batcher
+
+async def serve(host,port,version,max_batch,max_wait,cache_size,as_of=None):
+  engine = HccEngine(version,cache_size=cache_size)
+  server, _ = await start_server(host,port,engine,max_batch,max_wait,as_of)
+  async with server:
+    await server.serve_forever()
+
+async def request(reader,writer,method,path,payload=None):
+  # (status code, payload) of one request on a keep-alive connection
+  body = json.dumps(payload).encode() if payload is not None else b""
+  writer.write(("%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" %
+                (method,path,len(body))).encode("latin-1") + body)
+  await writer.drain()
+  # a status line splits like a request line: (version, code, headers, body)
+  _, code, _, body = await read_request(reader)
+  return int(code), json.loads(body)
+
+async def stress(host,port,members,connections=64,repeat=4,version=None,as_of=None):
+  # POSTs every member `repeat` times over from `connections` concurrent
+  # keep-alive connections, singly and in small lists, mixed with malformed
+  # members, and returns the requests whose responses differ from scoring
+  # the members in one batch call
+  import random
+  expected = HccEngine(version).score_batch(list(members),as_of)
+  expected = dict((hicno,[float(expected[name][i]) for name in MODELS])
+                  for i, hicno in enumerate(expected["hicno"]))
+  bad_members = [{"hicno":"bad","sex":"female","dob":"19500101x"},
+                 {"hicno":"bad","sex":"female","dob":19500140},
+                 {"hicno":"bad","sex":"female","dob":"29990101"},
+                 {"hicno":"bad","sex":"female"},
+                 {"hicno":"bad","sex":"female","age":70,"diagnoses":["E1122"]},
+                 {"hicno":"bad","sex":"female","age":70,"diagnoses":[["E1122","x"]]},
+                 {"hicno":"bad","sex":"female","age":70,"diagnoses":[["E1122",0,1]]},
+                 {"hicno":"bad","sex":"female","age":70,"diagnoses":"E1122"},
+                 {"hicno":"bad","sex":"female","age":70,"original_reason_entitlement":"x"},
+                 {"hicno":"bad","sex":"female","age":70,"original_reason_entitlement":7},
+                 {"hicno":"bad","sex":"female","age":"seventy"},
+                 {"hicno":"bad","sex":1,"age":70},
+                 {"hicno":"bad","dob":"19500101"},
+                 "not a member"]
+  rnd = random.Random(0)
+  jobs = [[m] for m in members] * repeat
+  jobs += [list(members[i:i + 5]) for i in range(0,len(members),5)]
+  jobs += [[m] for m in bad_members] * repeat
+  rnd.shuffle(jobs)
+  failures = []
+  async def client(jobs):
+    reader, writer = await asyncio.open_connection(host,port)
+    try:
+      for job in jobs:
+        payload = job[0] if len(job) == 1 else job
+        code, result = await request(reader,writer,"POST","/score",payload)
+        if any(m in bad_members for m in job):
+          if code != 400:
+            failures.append((job,code,result))
+          continue
+        results = [result] if len(job) == 1 else result
+        if code != 200 or any(abs(r[name] - e) > 1e-9
+                              for r, m in zip(results,job)
+                              for name, e in zip(MODELS,expected[m["hicno"]])):
+          failures.append((job,code,result))
+    finally:
+      writer.close()
+  await asyncio.gather(*[client(jobs[i::connections]) for i in range(connections)])
+  return failures
+
+def run_stress(n,max_batch,max_wait,version=None,as_of=None):
+  # stress() against a server started on a free local port
+  from hcc_synthetic import synthetic_members
+  members = [dict(m,original_reason_entitlement=int(m["original_reason_entitlement"]))
+             for m in synthetic_members(n)]
+  async def main():
+    server, batcher = await start_server("127.0.0.1",0,HccEngine(version),max_batch,
+                                         max_wait,as_of)
+    port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    failures = await stress("127.0.0.1",port,members,version=version,as_of=as_of)
+    seconds = time.perf_counter() - start
+    server.close()
+    batcher.task.cancel()
+    return failures, seconds, batcher.stats()
+  return asyncio.run(main())
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="HCC micro-batching scoring server")
+  parser.add_argument("--host",default="127.0.0.1")
+  parser.add_argument("--port",type=int,default=8080)
+  parser.add_argument("--version",help="registered model version")
+  parser.add_argument("--max-batch",type=int,default=256)
+  parser.add_argument("--max-wait",type=float,default=0.005,help="seconds")
+  parser.add_argument("--cache-size",type=int,default=0)
+  parser.add_argument("--payment-year",type=int,
+                      help="age members as of February 1 of this year")
+  parser.add_argument("--stress",type=int,metavar="N",
+                      help="fire concurrent requests for N synthetic members at a "
+                           "server on a free port, check the results and exit")
+  args = parser.parse_args()
+  as_of = payment_year_as_of(args.payment_year) if args.payment_year else None
+  if args.stress:
+    failures, seconds, stats = run_stress(args.stress,args.max_batch,args.max_wait,
+                                          args.version,as_of)
+    print(json.dumps(stats,indent=1))
+    print("%d requests failed, %.0f members/s" %
+          (len(failures),stats["members"] / seconds))
+    sys.exit(1 if failures else 0)
+  asyncio.run(serve(args.host,args.port,args.version,args.max_batch,
+                    args.max_wait,args.cache_size,as_of))
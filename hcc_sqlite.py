@@ -0,0 +1,248 @@
+import re
+import sqlite3
+import sys
+
+from hcc import as_of_date
+from hcc_compiled import MAX_AGE, SEXES, lookup_model, member_fields
+from hcc_stream import TRUE_VALUES
+
+# Scoring inside a SQLite database.  load_reference() writes a model's
+# reference tables next to the claims data, and score_database() scores
+# every member with one INSERT ... SELECT whose steps are the rules of
+# hcc.py in set-based SQL:
+#
+#   codes       distinct (icdcode, codetype) of each member, less excisions
+#   ben_cc      beneficiary_has_cc: edits where one applies, else hcc_cc
+#   ben_hcc     beneficiary_has_hcc: ben_cc less CCs overridden by another
+#   indicator   demographic cells, HCCs, DISABLED_HCCs and interactions
+#   scores      sum of coefficients per (member, model)
+#
+# The member table needs hicno, sex ('female'/'male') and age, or dob as
+# YYYYMMDD text (aged on as_of in SQL); orec and medicaid default to 0, and
+# a text medicaid flag counts as hcc_stream.flag counts it.  A negative age
+# (a dob after as_of) is an error, as in the compiled engine.
+# The diagnosis table needs hicno, icdcode and codetype.  As in the other
+# engines, a member with no matching indicator has no score row.
+
+REFERENCE_TABLES = {
+  "hcc_cc":"icdcode TEXT, codetype INTEGER, cc TEXT",
+  "hcc_edit":"icdcode TEXT, codetype INTEGER, cc TEXT, sex TEXT, max_age INTEGER",
+  "hcc_excised":"icdcode TEXT, codetype INTEGER, max_age INTEGER",
+  "hcc_overrides":"cc TEXT, overridden TEXT",
+  "hcc_dc":"dc TEXT, cc TEXT",
+  "hcc_hccee":"cc TEXT PRIMARY KEY",
+  "hcc_disabled":"cc TEXT PRIMARY KEY",
+  # side 1 and side 2 CCs of each interaction, dc groups resolved
+  "hcc_interaction":"name TEXT, side INTEGER, cc TEXT",
+  "hcc_demographic":"sex TEXT, age INTEGER, orec INTEGER, medicaid INTEGER, indicator TEXT",
+  "hcc_coefficient":"model TEXT, indicator TEXT, coefficient REAL"}
+
+REFERENCE_INDEXES = [
+  "hcc_cc (icdcode, codetype)",
+  "hcc_edit (icdcode, codetype)",
+  "hcc_excised (icdcode, codetype)",
+  "hcc_overrides (overridden)",
+  "hcc_interaction (cc, side)",
+  "hcc_demographic (sex, age, orec, medicaid)",
+  "hcc_coefficient (indicator)"]
+
+def _identifier(name):
+  # table names are written into the SQL, so only plain identifiers
+  if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$",name):
+    raise ValueError("not a table name: " + repr(name))
+  return name
+
+def _columns(conn,table):
+  return set(row[1] for row in conn.execute("PRAGMA table_info(%s)" % _identifier(table)))
+
+def reference_rows(model=None):
+  # table name -> rows of every reference table of model
+  model = lookup_model(model)
+  table = model.demographics
+  cells = []
+  i = 0
+  for sex in SEXES:
+    for age in range(MAX_AGE + 1):
+      for orec in range(table.orecs):
+        for medicaid in (0,1):
+          cells.extend((sex,age,orec,medicaid,ind) for ind in sorted(table.indicators[i]))
+          i += 1
+  return {
+    # cc_map is a dict, or the mapped hcc_refcache.IcdTable
+    "hcc_cc":[(icd,codetype,cc) for (icd,codetype), ccs in model.cc_map.items()
+              for cc in ccs],
+    "hcc_edit":[(icd,codetype,cc,sex,max_age)
+                for (icd,codetype), edits in model.edits.items()
+                for cc, sex, max_age in edits],
+    "hcc_excised":[(icd,codetype,max_age)
+                   for (icd,codetype), max_age in model.excisions.items()],
+    "hcc_overrides":[(cc,overridden) for cc, overriddens in model.overrides.items()
+                     for overridden in overriddens],
+    "hcc_dc":[(dc,cc) for dc, ccs in model.categories.items() for cc in ccs],
+    "hcc_hccee":[(cc,) for cc in model.hccees],
+    "hcc_disabled":[(cc,) for cc in model.disabled_hccs],
+    "hcc_interaction":[(name,side,cc) for name, first, second in model.interactions
+                       for side, group in ((1,first),(2,second)) for cc in group],
+    "hcc_demographic":cells,
+    "hcc_coefficient":[(name,var,coef) for name, (prefix, reg_vars) in model.regressions.items()
+                       for var in sorted(reg_vars)
+                       for coef in model.coefficients.get(prefix + var,())]}
+
+def load_reference(conn,model=None):
+  # (re)creates the reference tables of model in conn
+  rows = reference_rows(model)
+  with conn:
+    for table, columns in REFERENCE_TABLES.items():
+      conn.execute("DROP TABLE IF EXISTS %s" % table)
+      conn.execute("CREATE TABLE %s (%s)" % (table,columns))
+      if rows[table]:
+        conn.executemany("INSERT INTO %s VALUES (%s)" %
+                         (table,", ".join("?" * len(rows[table][0]))),rows[table])
+    for n, index in enumerate(REFERENCE_INDEXES):
+      conn.execute("CREATE INDEX IF NOT EXISTS hcc_index_%d ON %s" % (n,index))
+
+def load_members(conn,members,members_table="members",diagnoses_table="diagnoses",
+                 as_of=None):
+  # writes Beneficiaries or member dicts (see hcc_compiled.member_fields) to
+  # member and diagnosis tables, for data not already in the database
+  members_table = _identifier(members_table)
+  diagnoses_table = _identifier(diagnoses_table)
+  as_of = as_of_date(as_of)
+  with conn:
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (hicno TEXT PRIMARY KEY, sex TEXT, "
+                 "age INTEGER, orec INTEGER, medicaid INTEGER)" % members_table)
+    conn.execute("CREATE TABLE IF NOT EXISTS %s (hicno TEXT, icdcode TEXT, "
+                 "codetype INTEGER)" % diagnoses_table)
+    for member in members:
+      hicno, sex, age, orec, medicaid, diagnoses = member_fields(member,as_of)
+      conn.execute("INSERT INTO %s VALUES (?, ?, ?, ?, ?)" % members_table,
+                   (str(hicno),sex,age,int(orec),int(medicaid == True)))
+      conn.executemany("INSERT INTO %s VALUES (?, ?, ?)" % diagnoses_table,
+                       [(str(hicno),icd,int(codetype)) for icd, codetype in diagnoses])
+
+def indicator_sql(conn,members_table="members",diagnoses_table="diagnoses",as_of=None):
+  # the WITH clause that ends in indicator(hicno, indicator)
+  members_table = _identifier(members_table)
+  diagnoses_table = _identifier(diagnoses_table)
+  columns = _columns(conn,members_table)
+  if "age" in columns:
+    age = "m.age"
+  elif "dob" in columns:
+    as_of = as_of_date(as_of).strftime("%Y%m%d")
+    age = ("(%s - CAST(substr(m.dob, 1, 4) AS INTEGER) - ('%s' < substr(m.dob, 5, 4)))" %
+           (as_of[:4],as_of[4:]))
+  else:
+    raise ValueError("%s has neither an age nor a dob column" % members_table)
+  orec = "COALESCE(m.orec, 0)" if "orec" in columns else "0"
+  medicaid = "0"
+  if "medicaid" in columns:
+    # text flags are read as hcc_stream.flag reads them ('Y', 'true', ...)
+    medicaid = ("CASE WHEN typeof(m.medicaid) = 'text' THEN trim(m.medicaid) IN (%s) "
+                "ELSE COALESCE(m.medicaid, 0) != 0 END" %
+                ", ".join("'%s'" % v for v in sorted(TRUE_VALUES)))
+  return """
+WITH
+member AS MATERIALIZED (
+  SELECT m.hicno, m.sex, %(age)s AS age, %(orec)s AS orec,
+         CASE WHEN %(medicaid)s THEN 1 ELSE 0 END AS medicaid
+  FROM %(members)s m),
+codes AS MATERIALIZED (
+  SELECT DISTINCT m.hicno, m.sex, m.age, d.icdcode, CAST(d.codetype AS INTEGER) AS codetype
+  FROM member m JOIN %(diagnoses)s d ON d.hicno = m.hicno
+  WHERE NOT EXISTS (SELECT 1 FROM hcc_excised x
+                    WHERE x.icdcode = d.icdcode AND x.codetype = CAST(d.codetype AS INTEGER)
+                      AND m.age < x.max_age)),
+edited AS MATERIALIZED (
+  SELECT c.hicno, c.icdcode, c.codetype, e.cc
+  FROM codes c JOIN hcc_edit e ON e.icdcode = c.icdcode AND e.codetype = c.codetype
+  WHERE (e.sex IS NOT NULL AND e.sex = c.sex) OR (e.sex IS NULL AND c.age < e.max_age)),
+ben_cc AS MATERIALIZED (
+  SELECT hicno, cc FROM edited
+  UNION
+  SELECT c.hicno, cc.cc
+  FROM codes c JOIN hcc_cc cc ON cc.icdcode = c.icdcode AND cc.codetype = c.codetype
+  WHERE NOT EXISTS (SELECT 1 FROM edited e
+                    WHERE e.hicno = c.hicno AND e.icdcode = c.icdcode
+                      AND e.codetype = c.codetype)),
+ben_hcc AS MATERIALIZED (
+  SELECT b.hicno, b.cc FROM ben_cc b
+  WHERE NOT EXISTS (SELECT 1 FROM hcc_overrides o JOIN ben_cc b2 ON b2.cc = o.cc
+                    WHERE o.overridden = b.cc AND b2.hicno = b.hicno)),
+indicator AS MATERIALIZED (
+  SELECT m.hicno, d.indicator
+  FROM member m JOIN hcc_demographic d
+    ON d.sex = m.sex AND d.age = MIN(m.age, %(max_age)d) AND d.orec = m.orec
+       AND d.medicaid = m.medicaid
+  UNION
+  SELECT h.hicno, 'HCC' || h.cc FROM ben_hcc h JOIN hcc_hccee e ON e.cc = h.cc
+  UNION
+  SELECT h.hicno, 'DISABLED_HCC' || h.cc
+  FROM ben_hcc h JOIN hcc_disabled x ON x.cc = h.cc JOIN member m ON m.hicno = h.hicno
+  WHERE m.age < 65 AND m.orec != 0
+  UNION
+  SELECT h1.hicno, i1.name
+  FROM ben_hcc h1 JOIN hcc_interaction i1 ON i1.cc = h1.cc AND i1.side = 1
+       JOIN hcc_interaction i2 ON i2.name = i1.name AND i2.side = 2
+       JOIN ben_hcc h2 ON h2.hicno = h1.hicno AND h2.cc = i2.cc)
+""" % {"age":age, "orec":orec, "medicaid":medicaid, "members":members_table,
+       "diagnoses":diagnoses_table, "max_age":MAX_AGE}
+
+def score_database(conn,members_table="members",diagnoses_table="diagnoses",
+                   result_table="hcc_scores",indicator_table=None,model=None,
+                   as_of=None,reference=True):
+  # scores every member into result_table(hicno, model, score), and their
+  # indicators into indicator_table(hicno, indicator) when given; returns
+  # the number of score rows.  reference=False reuses the reference tables
+  # already in conn.
+  result_table = _identifier(result_table)
+  if reference:
+    load_reference(conn,model)
+  with_clause = indicator_sql(conn,members_table,diagnoses_table,as_of)
+  negative = conn.execute("%s SELECT hicno, age FROM member WHERE age < 0 LIMIT 1" %
+                          with_clause).fetchone()
+  if negative is not None:
+    raise ValueError("member %s has a negative age: %d" % negative)
+  with conn:
+    conn.execute("DROP TABLE IF EXISTS %s" % result_table)
+    conn.execute("CREATE TABLE %s (hicno TEXT, model TEXT, score REAL)" % result_table)
+    conn.execute("INSERT INTO %s %s SELECT i.hicno, c.model, SUM(c.coefficient) "
+                 "FROM indicator i JOIN hcc_coefficient c ON c.indicator = i.indicator "
+                 "GROUP BY i.hicno, c.model" % (result_table,with_clause))
+    if indicator_table is not None:
+      indicator_table = _identifier(indicator_table)
+      conn.execute("DROP TABLE IF EXISTS %s" % indicator_table)
+      conn.execute("CREATE TABLE %s (hicno TEXT, indicator TEXT)" % indicator_table)
+      conn.execute("INSERT INTO %s %s SELECT hicno, indicator FROM indicator" %
+                   (indicator_table,with_clause))
+  return conn.execute("SELECT COUNT(*) FROM %s" % result_table).fetchone()[0]
+
+def compare_database(members,as_of=None,tolerance=1e-9):
+  # scores members in an in-memory database and with the compiled engine;
+  # returns the hicnos whose scores or indicators differ
+  model = lookup_model(None)
+  members = list(members)
+  conn = sqlite3.connect(":memory:")
+  load_members(conn,members,as_of=as_of)
+  score_database(conn,indicator_table="hcc_indicators",as_of=as_of)
+  scores, indicators = {}, {}
+  for hicno, name, score in conn.execute("SELECT hicno, model, score FROM hcc_scores"):
+    scores.setdefault(hicno,{})[name] = score
+  for hicno, ind in conn.execute("SELECT hicno, indicator FROM hcc_indicators"):
+    indicators.setdefault(hicno,set()).add(ind)
+  bad = []
+  for member in members:
+    hicno, sex, age, orec, medicaid, diagnoses = member_fields(member,as_of)
+    inds = model.indicators(sex,age,orec,medicaid,diagnoses)
+    expected = model.scores(inds)
+    got = scores.get(str(hicno),{})
+    if (inds != indicators.get(str(hicno),set()) or set(expected) != set(got) or
+        any(abs(expected[k] - got[k]) > tolerance for k in expected)):
+      bad.append(hicno)
+  return bad
+
+if __name__ == "__main__":
+  from hcc_synthetic import synthetic_members
+  n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  bad = compare_database(synthetic_members(n))
+  print("%d of %d members differ" % (len(bad),n))
+  sys.exit(1 if bad else 0)
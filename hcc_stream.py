@@ -0,0 +1,120 @@
+from itertools import groupby
+import csv
+
+from hcc import EntitlementReason
+from hcc import age_as_of, as_of_date
+from hcc_compiled import dob_date, lookup_model
+
+# Streaming ingestion of member and claim diagnosis files.  Both files must
+# be sorted by hicno (as text).  Members are read one at a time and matched
+# against the next group of diagnoses, so memory is bounded by the largest
+# single member rather than by the size of either file.  A file out of
+# order, or diagnoses of a hicno the member file does not have, raise a
+# ValueError as soon as they are read, before any later member is yielded.
+#
+# member columns:    hicno, sex, dob (YYYYMMDD), original_reason_entitlement,
+#                    medicaid, newenrollee_medicaid
+# diagnosis columns: hicno, icdcode, codetype (0 for ICD10, 9 for ICD9)
+#
+# Files ending in .parquet are read in record batches with pyarrow.
+
+TRUE_VALUES = frozenset(["1","true","True","TRUE","Y","y","yes","Yes"])
+
+def read_rows(path,batch_size=65536):
+  if path.endswith(".parquet"):
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+      for row in batch.to_pylist():
+        yield row
+  else:
+    with open(path,newline="") as f:
+      for row in csv.DictReader(f):
+        yield row
+
+def flag(value):
+  if isinstance(value,str):
+    return value.strip() in TRUE_VALUES
+  return bool(value)
+
+def parse_member(row):
+  orec = row.get("original_reason_entitlement")
+  return {"hicno":str(row["hicno"]),
+          "sex":row["sex"],
+          "dob":str(row["dob"]),
+          "original_reason_entitlement":EntitlementReason(int(orec or 0)),
+          "medicaid":flag(row.get("medicaid",False)),
+          "newenrollee_medicaid":flag(row.get("newenrollee_medicaid",False))}
+
+def diagnosis_groups(rows):
+  for hicno, group in groupby(rows,key=lambda row: str(row["hicno"])):
+    yield hicno, [(row["icdcode"].strip(),int(row["codetype"])) for row in group]
+
+def sorted_groups(groups,path):
+  # (hicno, ...) groups, each checked against the next one before it is
+  # yielded, so a group out of order fails before it is matched
+  groups = iter(groups)
+  current = next(groups,None)
+  for following in groups:
+    if following[0] <= current[0]:
+      raise ValueError("%s is not sorted by hicno: %s after %s" %
+                       (path,following[0],current[0]))
+    yield current
+    current = following
+  if current is not None:
+    yield current
+
+def stream_members(members_path,diagnoses_path,as_of=None):
+  # yields member dicts, each with its 'diagnoses' and its age on as_of
+  # (see hcc.as_of_date), in member file order
+  return merge_members(read_rows(members_path),read_rows(diagnoses_path),as_of,
+                       members_path,diagnoses_path)
+
+def merge_members(member_rows,diagnosis_rows,as_of=None,members_path="members",
+                  diagnoses_path="diagnoses"):
+  # stream_members over rows already read, e.g. one byte range of each file
+  # (see hcc_parallel.imap_file_scores); the paths only name them in errors
+  as_of = as_of_date(as_of)
+  groups = sorted_groups(diagnosis_groups(diagnosis_rows),diagnoses_path)
+  members = sorted_groups(((m["hicno"],m) for m in map(parse_member,member_rows)),
+                          members_path)
+  pending = next(groups,None)
+  for hicno, member in members:
+    if pending is not None and pending[0] < hicno:
+      raise ValueError("%s has diagnoses for hicno %s, which %s does not have" %
+                       (diagnoses_path,pending[0],members_path))
+    member["age"] = age_as_of(dob_date(member["dob"]),as_of)
+    member["diagnoses"] = []
+    if pending is not None and pending[0] == hicno:
+      member["diagnoses"] = pending[1]
+      pending = next(groups,None)
+    yield member
+  if pending is not None:
+    raise ValueError("%s has diagnoses for hicno %s, which %s does not have" %
+                     (diagnoses_path,pending[0],members_path))
+
+def stream_output(members_path,diagnoses_path,model=None,sparse=False,as_of=None):
+  # yields output(B,Col,Val) rows as (hicno, Col, Val), one member at a time;
+  # sparse leaves out the (Col, 0) rows and sex and age
+  model = lookup_model(model)
+  output = model.member_sparse_output if sparse else model.member_output
+  for member in stream_members(members_path,diagnoses_path,as_of):
+    for col, val in output(member):
+      yield member["hicno"], col, val
+
+def stream_scores(members_path,diagnoses_path,model=None,as_of=None):
+  # yields (hicno, {model: score}) one member at a time
+  model = lookup_model(model)
+  for member in stream_members(members_path,diagnoses_path,as_of):
+    yield member["hicno"], model.scores(model.member_indicators(member))
+
+def chunked(members,size):
+  # groups a member stream into lists of at most size members, e.g. to feed
+  # hcc_batch.score_batch one bounded chunk at a time
+  chunk = []
+  for member in members:
+    chunk.append(member)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
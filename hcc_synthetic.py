@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+import random
+
+from hcc import (EntitlementReason, Beneficiary, Diagnosis, read_cc_facts,
+                 cc_edits, cc_excisions)
+
+# Seeded generator of made-up members and diagnoses.  Ages cover every
+# age/sex cell used by the indicators, and the codes are drawn from the
+# icd10.txt/icd9.txt vocabularies plus the codes that trigger edits and
+# excisions, with a few codes that map to no CC at all.
+
+UNMAPPED_CODES = [("Z0000",0),("V700",9),("R69",0),("7999",9)]
+
+def code_vocabulary():
+  vocab = []
+  for f, icdcodetype in (("icd10.txt",0),("icd9.txt",9)):
+    vocab.extend(sorted(set((icdE,icdcodetype) for icdE, _ in read_cc_facts(f))))
+  return vocab
+
+def edit_vocabulary():
+  vocab = []
+  for icdtype, _, _, _, icds in cc_edits():
+    vocab.extend((icd,icdtype) for icd in icds)
+  for icdtype, _, icds in cc_excisions():
+    vocab.extend((icd,icdtype) for icd in icds)
+  return vocab
+
+def code_count(rnd):
+  # roughly a fifth of members carry no codes, the rest a long tail
+  if rnd.random() < 0.2:
+    return 0
+  return 1 + int(rnd.expovariate(1/6.0))
+
+def synthetic_members(n,seed=0,as_of=None):
+  # yields dicts with the Beneficiary constructor fields plus a
+  # 'diagnoses' list of (icdcode, codetype) pairs
+  rnd = random.Random(seed)
+  as_of = as_of or datetime.now()
+  vocab = code_vocabulary()
+  edits = edit_vocabulary()
+  for i in range(n):
+    age = rnd.randint(0,120)
+    dob = as_of - timedelta(days=int(age*365.25) + rnd.randint(1,364))
+    diagnoses = []
+    for _ in range(code_count(rnd)):
+      r = rnd.random()
+      if r < 0.05:
+        diagnoses.append(rnd.choice(edits))
+      elif r < 0.08:
+        diagnoses.append(rnd.choice(UNMAPPED_CODES))
+      else:
+        diagnoses.append(rnd.choice(vocab))
+    yield {"hicno":"SYN%09d" % i,
+           "sex":rnd.choice(["male","female"]),
+           "dob":dob.strftime("%Y%m%d"),
+           "original_reason_entitlement":EntitlementReason(rnd.choice([0,0,0,1,1,2,3])),
+           "medicaid":rnd.random() < 0.25,
+           "newenrollee_medicaid":rnd.random() < 0.1,
+           "diagnoses":diagnoses}
+
+def synthetic_beneficiaries(n,seed=0,as_of=None):
+  beneficiaries = []
+  for member in synthetic_members(n,seed,as_of):
+    diagnoses = member.pop("diagnoses")
+    ben = Beneficiary(**member)
+    for icdcode, codetype in diagnoses:
+      ben.add_diagnosis(Diagnosis(ben,icdcode,codetype))
+    beneficiaries.append(ben)
+  return beneficiaries
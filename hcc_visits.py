@@ -0,0 +1,135 @@
+from types import MappingProxyType
+
+import numpy as np
+
+from hcc_stream import chunked
+
+# Visit categories of claim lines by CPT/HCPCS code.  VisitIndex compiles the
+# code families below (the AlgorexCore lists) into one read-only code ->
+# category bitmask dict, and VisitTable tags claims a column chunk at a time:
+# each chunk's distinct codes and hicnos are looked up once (np.unique), and
+# the per-member counts and last visit dates are add.at/maximum.at reductions
+# over the chunk's rows.  The member tables grow by doubling.
+# Dates are YYYYMMDD strings or integers, or datetime64 values, and are kept
+# as YYYYMMDD integers (0 for no visit).
+
+VISIT_CODES = [
+  ("office",["99201","99202","99203","99204","99205","99211","99212","99213","99214","99215"]),
+  ("nursing_facility",["99304","99304","99305","99306","99307","99308","99309","99310",
+                       "99315","99316","99318"]),
+  ("rest_home",["99324","99325","99326","99327","99328","99334","99335","99336","99337",
+                "99339","99340"]),
+  ("home_services",["99341","99342","99343","99344","99345","99347","99348","99349","99350",
+                    "99490","99495","99496"]),
+  ("wellness",["G0402","G0438","G0439"])]
+
+class VisitIndex:
+  def __init__(self,families=VISIT_CODES):
+    # families are (category, codes); a code may be in several
+    self.categories = [name for name, _ in families]
+    index = {}
+    for bit, (_, codes) in enumerate(families):
+      for code in codes:
+        index[code] = index.get(code,0) | 1 << bit
+    # code -> category bitmask, read only once built
+    self.codes = MappingProxyType(index)
+
+  def classify(self,codes):
+    # category bitmask of every code of a column, 0 for none
+    codes = np.asarray(codes).astype(str)
+    distinct, inverse = np.unique(codes,return_inverse=True)
+    masks = np.array([self.codes.get(code.strip().upper(),0) for code in distinct],
+                     dtype=np.int64)
+    return masks[inverse.reshape(-1)] if len(codes) else np.zeros(0,dtype=np.int64)
+
+def visit_dates(dates):
+  # YYYYMMDD integers of a column of dates
+  dates = np.asarray(dates)
+  if dates.dtype.kind == "M":
+    days = dates.astype("M8[D]")
+    months = days.astype("M8[M]")
+    years = days.astype("M8[Y]").astype(np.int64) + 1970
+    return (years * 10000 + (months.astype(np.int64) % 12 + 1) * 100 +
+            (days - months.astype("M8[D]")).astype(np.int64) + 1)
+  return dates.astype(np.int64)
+
+class VisitTable:
+  def __init__(self,index=None):
+    self.index = index or VisitIndex()
+    self.hicnos = []
+    self.ids = {}
+    # (capacity, categories) visit line counts and last YYYYMMDD dates; the
+    # first len(self) rows are in use
+    self._counts = np.zeros((0,len(self.index.categories)),dtype=np.int64)
+    self._last = np.zeros((0,len(self.index.categories)),dtype=np.int64)
+
+  def __len__(self):
+    return len(self.hicnos)
+
+  @property
+  def counts(self):
+    return self._counts[:len(self.hicnos)]
+
+  @property
+  def last(self):
+    return self._last[:len(self.hicnos)]
+
+  def _member_ids(self,hicnos):
+    # global member id of every distinct hicno, adding new members
+    ids = []
+    for hicno in hicnos:
+      i = self.ids.get(hicno)
+      if i is None:
+        i = self.ids[hicno] = len(self.hicnos)
+        self.hicnos.append(hicno)
+      ids.append(i)
+    if len(self.hicnos) > len(self._counts):
+      capacity = max(len(self.hicnos),2 * len(self._counts),1024)
+      for name in ("_counts","_last"):
+        table = np.zeros((capacity,len(self.index.categories)),dtype=np.int64)
+        table[:len(getattr(self,name))] = getattr(self,name)
+        setattr(self,name,table)
+    return np.array(ids,dtype=np.int64)
+
+  def add(self,hicnos,codes,dates):
+    # tags one chunk of claim lines given as columns
+    masks = self.index.classify(codes)
+    visits = masks != 0
+    if not visits.any():
+      return
+    distinct, inverse = np.unique(np.asarray(hicnos)[visits],return_inverse=True)
+    members = self._member_ids(distinct.tolist())[inverse.reshape(-1)]
+    masks, dates = masks[visits], visit_dates(dates)[visits]
+    for c in range(len(self.index.categories)):
+      tagged = (masks & (1 << c)) != 0
+      if tagged.any():
+        np.add.at(self._counts[:,c],members[tagged],1)
+        np.maximum.at(self._last[:,c],members[tagged],dates[tagged])
+
+  def extend(self,claims,chunk_size=100000):
+    # tags a stream of (hicno, code, date) claim lines
+    for chunk in chunked(claims,chunk_size):
+      hicnos, codes, dates = zip(*chunk)
+      self.add(hicnos,codes,dates)
+
+  def member(self,hicno):
+    # {category: (count, last date)} of one member
+    i = self.ids.get(hicno)
+    return dict((category,(int(self.counts[i,c]),int(self.last[i,c])) if i is not None
+                          else (0,0))
+                for c, category in enumerate(self.index.categories))
+
+  def count(self,hicnos,category):
+    # visit counts of category for an array of hicnos, 0 for unseen members
+    c = self.index.categories.index(category)
+    return np.array([self.counts[self.ids[h],c] if h in self.ids else 0 for h in hicnos],
+                    dtype=np.int64)
+
+def care_gaps(visits,scores,model="community",min_score=1.0,category="wellness"):
+  # (hicno, score) of the members of a score_batch result scoring at least
+  # min_score in model with no visit of category, highest score first
+  hicnos = np.asarray(scores["hicno"])
+  score = np.asarray(scores[model])
+  gaps = (score >= min_score) & (visits.count(hicnos,category) == 0)
+  order = np.flatnonzero(gaps)[np.argsort(-score[gaps],kind="stable")]
+  return [(hicnos[i],float(score[i])) for i in order]